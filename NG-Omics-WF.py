@@ -23,12 +23,29 @@ import argparse
 from argparse import RawTextHelpFormatter
 import math
 import subprocess
+import shutil
 import time
 import logging
 import textwrap
 import imp
 import collections
+import itertools
+import heapq
 import xml.etree.ElementTree as ET
+import select
+import signal
+import atexit
+import errno
+import struct
+import glob
+import stat
+import fcntl
+import getpass
+import hashlib
+import json
+import sqlite3
+import socket
+from multiprocessing.pool import ThreadPool
 
 __author__ = 'Weizhong Li'
 
@@ -46,15 +63,58 @@ banner = '''
 '''
 NGS_config = None
 NGS_samples = []
+project_sample_id = 'WF-project'          # pseudo sample of 'scope': 'project' jobs, their output is in WF-project/<job_id>
+pseudo_sample_members = collections.OrderedDict()  # pseudo sample (project, group) => samples it reduces over
+sample_groups_cache = {}                  # as sample_groups_cache[i] = (groups by $DATA.i, group of each sample)
+scatter_jobs = {}                         # scatter job => {'split': split job, 'chunks': [chunk jobs], ...}
+scatter_split_jobs = {}                   # split job => scatter job
+scatter_chunk_jobs = set()
+temp_bytes_deleted = 0                    # bytes of temp_files deleted by this run
 NGS_sample_data = {}
 NGS_opts = {}
 pwd = os.path.abspath('.')
 subset_flag = False
 subset_jobs = []
 qstat_xml_data = collections.defaultdict(dict)
+qstat_xml_time = 0                        # time of qstat_xml_data, 0 if never queried or invalidated
+qstat_ttl = 5                             # seconds qstat result is reused, by main loop and by snapshot through cache file
+queue_system = 'SGE'                      # batch system backend for qsub / qsub-pe executions, see queue_backends
 job_list = collections.defaultdict(dict)  # as job_list[$t_job_id][$t_sample_id] = {}
 execution_submitted = {}                  # number of submitted jobs (qsub) or threads (local sh)
-local_subprocess = {}
+execution_mem_submitted = {}              # memory (MB) of running local sh jobs
+job_dependents = collections.defaultdict(list)  # as job_dependents[(t_job_id, t_sample_id)] = [(t_job_id2, t_sample_id), ...]
+job_status_count = collections.Counter()  # number of job / sample in each status
+job_status_by_job = collections.defaultdict(collections.Counter)  # as job_status_by_job[t_job_id][status] = number of samples
+status_rows = {}                          # as status_rows[t_sample_id] = list of status chars, one per job in status_columns
+status_columns = {}                       # as status_columns[t_job_id] = position in status_rows
+status_changes = 0                        # number of status changes, WF-sh/WF-status.json is written after a change
+jobs_to_check = set()                     # (t_job_id, t_sample_id) submitted or error, checked every loop
+jobs_dirty = set()                        # (t_job_id, t_sample_id) waiting, upstream status changed since last check
+ready_queue = collections.defaultdict(list)  # as ready_queue[t_execution_id] = heap of (priority, t_job_id, t_sample_id)
+schedule_policy = 'breadth'               # order of ready jobs: breadth, depth or lpt, see option --policy
+job_rank = {}                             # as job_rank[t_job_id] = position in job_order
+sample_data_size = {}                     # as sample_data_size[t_sample_id] = total bytes of $DATA files
+array_job_no = 0                          # number of array jobs submitted by this run
+sample_index = {}                         # as sample_index[t_sample_id] = order in sample file
+job_order = []                            # job ids by critical path weight, order of dispatching
+job_runtime = {}                          # as job_runtime[t_job_id] = expected seconds per job / sample
+runtime_samples_max = 50                  # max number of samples to read WF.cpu for runtime history
+local_subprocess = {}                     # as local_subprocess[pid] = time started, children of this script not reaped yet
+local_exit_status = {}                    # as local_exit_status[pid] = status from os.waitpid() of reaped children
+state_db = None                           # sqlite3 connection to WF-sh/WF-state.db, job / sample state of the project
+status_read_only = False                  # True for -J snapshot --format, no file and no state store is written
+state_scan_threads = 16                   # threads to rebuild state from WF-sh/*.pids and WF.* files
+output_cache_dir = None                   # output cache shared by runs and projects, see option --cache
+output_cache_quota = 0                    # max bytes of output cache, 0 for no limit
+output_cache_db = None                    # sqlite3 connection to index of output cache
+wakeup_pipe = None                        # self-pipe, written on SIGCHLD, read end watched by the main loop
+inotify_fd = None                         # inotify instance watching WF.exit of submitted jobs
+inotify_watches = {}                      # as inotify_watches[(t_job_id, t_sample_id)] = watch descriptor
+libc = None
+work_queue_mode = 'unix'                  # work queue service for batch-run commands, unix, tcp or off
+work_queue_server = None                  # listening socket of the work queue service
+poll_interval_default = 10                # seconds between queue status checks for cluster executions
+poll_interval_max = 120                   # longest wait when nothing else wakes up the main loop
 ############## END Global variables
 
 
@@ -121,52 +181,145 @@ def read_samples(args):
         pass
       else:
         fatal_error('file exist: ' + sample, exit_code=1)
-    else:
+    elif not status_read_only:
       if os.system("mkdir " + sample):
         fatal_error('can not mkdir: ' + sample, exit_code=1)
   return
 
 
 def task_level_jobs(NGS_config):
-  '''according to dependancy, make level of jobs'''
-  job_level = {}
-  while True:
-    change_flag = False
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      t_injobs = []
-      if 'injobs' in t_job.keys():
-        t_injobs = t_job['injobs']
-
-      if len(t_injobs) > 0:
-        max_level_injob = 0
-        for j in t_injobs:
-          if not j in job_level.keys():
-            continue
-            if job_level[j] > max_level_injob:
-              max_level_injob = job_level[j]
-        if max_level_injob == 1:
-          continue
-        max_level_injob +=1  #### one more level 
-        if (t_job_id in job_level.keys()) and (job_level[t_job_id] >= max_level_injob):
-          continue
-        job_level[t_job_id]=max_level_injob
-        change_flag = 1
-      else:
-        if not t_job_id in job_level.keys():
-          job_level[t_job_id]=1
-          change_flag = True
+  '''according to dependancy, make level of jobs by topological sort (Kahn),
+  and critical path weight of jobs, i.e. longest runtime from a job to the end of workflow'''
+  global job_order
+  NGS_batch_jobs = NGS_config.NGS_batch_jobs
+  in_degree = {}
+  dependents = collections.defaultdict(list)
+  for t_job_id in NGS_batch_jobs.keys():
+    t_injobs = NGS_batch_jobs[t_job_id].get('injobs', [])
+    for j in t_injobs:
+      if not j in NGS_batch_jobs:
+        fatal_error('unknown injob ' + j + ' of job ' + t_job_id, exit_code=1)
+      dependents[j].append(t_job_id)
+    in_degree[t_job_id] = len(t_injobs)
 
-    if not change_flag: break
-
-  # print job_level
-  for t_job_id in NGS_config.NGS_batch_jobs.keys():
-    NGS_config.NGS_batch_jobs[t_job_id]['job_level'] = job_level[t_job_id]
-      
+  job_level = {}
+  topo_order = []
+  queue = collections.deque(sorted([j for j in in_degree.keys() if in_degree[j] == 0]))
+  while queue:
+    t_job_id = queue.popleft()
+    topo_order.append(t_job_id)
+    t_injobs = NGS_batch_jobs[t_job_id].get('injobs', [])
+    job_level[t_job_id] = 1 + max([job_level[j] for j in t_injobs] + [0])
+    for j in dependents[t_job_id]:
+      in_degree[j] -= 1
+      if in_degree[j] == 0:
+        queue.append(j)
+
+  if len(topo_order) < len(NGS_batch_jobs):
+    t_cycle = sorted([j for j in in_degree.keys() if in_degree[j] > 0])
+    fatal_error('dependency cycle among jobs: ' + ','.join(t_cycle), exit_code=1)
+
+  #### critical path, walk jobs in reverse topological order
+  critical_path = {}
+  for t_job_id in reversed(topo_order):
+    critical_path[t_job_id] = job_runtime_estimate(NGS_config, t_job_id) + \
+                              max([critical_path[j] for j in dependents[t_job_id]] + [0])
+
+  for t_job_id in NGS_batch_jobs.keys():
+    NGS_batch_jobs[t_job_id]['job_level'] = job_level[t_job_id]
+    NGS_batch_jobs[t_job_id]['critical_path'] = critical_path[t_job_id]
+
+  #### jobs on the longest path are dispatched first
+  job_order = sorted(topo_order, key=lambda j: (-critical_path[j], job_level[j], j))
   return
 #### END task_level_jobs(NGS_config)
 
 
+def job_samples(NGS_config, t_job_id):
+  '''samples of a job, the pseudo sample project_sample_id for a project job that runs once per workflow run,
+  a pseudo sample per group for a group job'''
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_scope = t_job.get('scope', 'sample')
+  if t_scope == 'project':
+    return [project_sample_id]
+  if t_scope == 'group':
+    return sample_groups(t_job['group_by'])[0].keys()
+  return NGS_samples
+
+
+def sample_groups(t_col):
+  '''groups of samples by sample data column $DATA.t_col
+  return ({pseudo sample of group: [samples]}, {sample: pseudo sample of its group}), groups in sample file order'''
+  if not t_col in sample_groups_cache:
+    t_groups = collections.OrderedDict()
+    t_sample_group = {}
+    for t_sample_id in NGS_samples:
+      t_data = NGS_sample_data[t_sample_id]
+      if t_col >= len(t_data):
+        fatal_error('sample {0} has no $DATA.{1} to group by'.format(t_sample_id, t_col), exit_code=1)
+      t_group_id = 'WF-group{0}-{1}'.format(t_col, re.sub(r'[^\w\-.]', '_', t_data[t_col]))
+      t_groups.setdefault(t_group_id, []).append(t_sample_id)
+      t_sample_group[t_sample_id] = t_group_id
+    sample_groups_cache[t_col] = (t_groups, t_sample_group)
+    pseudo_sample_members.update(t_groups)
+  return sample_groups_cache[t_col]
+
+
+def job_upstream(NGS_config, t_injob, t_sample_id):
+  '''job / samples of injob t_injob that job / sample t_sample_id depends on
+  a pseudo sample (project or group) depends on the injob of all its samples, a sample on the project job
+  or on the group job of its group'''
+  t_job = NGS_config.NGS_batch_jobs[t_injob]
+  t_scope = t_job.get('scope', 'sample')
+  if t_scope == 'project':
+    return [(t_injob, project_sample_id)]
+  if t_scope == 'sample':
+    if t_sample_id in pseudo_sample_members:
+      return [(t_injob, x) for x in pseudo_sample_members[t_sample_id]]
+    return [(t_injob, t_sample_id)]
+  t_groups, t_sample_group = sample_groups(t_job['group_by'])
+  if t_sample_id in t_groups:
+    return [(t_injob, t_sample_id)]
+  if t_sample_id == project_sample_id:
+    return [(t_injob, x) for x in t_groups.keys()]
+  if t_sample_id in t_sample_group:
+    return [(t_injob, t_sample_group[t_sample_id])]
+  fatal_error('{0} depends on group job {1} grouped by another column'.format(t_sample_id, t_injob), exit_code=1)
+
+
+def job_runtime_history(NGS_config, t_job_id):
+  '''average time_spent of a job from WF.cpu files of previous runs, None if not available'''
+  t_times = []
+  t_samples_checked = 0
+  for t_sample_id in job_samples(NGS_config, t_job_id):
+    f_cpu = pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.cpu'
+    if not os.path.exists(f_cpu): continue
+    try:
+      f = open(f_cpu, 'r')
+      for line in f:
+        m = re.search('time_spent=(\d+)', line)
+        if m: t_times.append(int(m.group(1)))
+      f.close()
+    except IOError:
+      continue
+    t_samples_checked += 1
+    if t_samples_checked >= runtime_samples_max: break
+  if len(t_times) == 0: return None
+  return float(sum(t_times)) / len(t_times)
+
+
+def job_runtime_estimate(NGS_config, t_job_id):
+  '''expected runtime of a job / sample in seconds, from history or from average of other jobs'''
+  if not job_runtime:
+    for j in NGS_config.NGS_batch_jobs.keys():
+      job_runtime[j] = job_runtime_history(NGS_config, j)
+    t_known = [x for x in job_runtime.values() if x is not None]
+    t_default = float(sum(t_known)) / len(t_known) if t_known else 1.0
+    for j in job_runtime.keys():
+      if job_runtime[j] is None: job_runtime[j] = t_default
+  return job_runtime[t_job_id]
+
+
 def add_subset_jobs_by_dependency(NGS_config):
   '''add dependant jobs'''
   while True:
@@ -182,10 +335,101 @@ def add_subset_jobs_by_dependency(NGS_config):
 #### END add_subset_jobs_by_dependency()
 
        
+def qsub_header(t_execution, t_job, t_no_cmds):
+  '''parallel environment and memory request of t_no_cmds commands of a job in one qsub'''
+  return queue_backends[queue_system]['header'](t_execution, t_job, t_no_cmds)
+
+
+########## command template
+#### a command is parsed once per job into literal and placeholder segments, then rendered per sample by one join
+#### placeholders: $SAMPLE $SELF $ENV.name $DATA.i $INJOBS.i $CMDOPTS.i
+####               $PROJECT.job_id: absolute path of output dir of project job job_id
+####               $INJOB_DIRS.i: absolute paths of output dirs of $INJOBS.i this job / sample depends on,
+####                 for a project or group job, one per sample, separated by space
+####               $GROUP_SAMPLES: samples of a project or group job, the sample itself for a sample job
+#### the longest index / ENV name / job_id wins, so $DATA.10 is never taken as $DATA.1 followed by 0
+#### values are inserted as they are, they are not searched for placeholders again
+command_placeholder_re = re.compile(r'\$(SAMPLE|SELF|GROUP_SAMPLES|ENV\.(\w+)|PROJECT\.([\w\-]+)|(DATA|INJOBS|CMDOPTS|INJOB_DIRS)\.(\d+))')
+
+def longest_key_prefix(t_word, t_dict):
+  '''longest key of t_dict that t_word starts with, None if no such key'''
+  t_keys = [x for x in t_dict.keys() if t_word.startswith(x)]
+  if t_keys: return max(t_keys, key=len)
+  return None
+
+
+def compile_command_template(t_command, t_job_id, t_env, t_injobs, t_cmd_opts, t_project_dirs=None):
+  '''parse a command into segments, a segment is a literal string, or the index of $DATA.i, or None for $SAMPLE,
+  or (name, i, placeholder) for a list placeholder, $INJOB_DIRS.i or $GROUP_SAMPLES
+  placeholders that are the same for all samples are replaced here
+  t_project_dirs: {job_id: output dir} of project jobs'''
+  if t_project_dirs is None: t_project_dirs = {}
+  t_segments = []
+  t_literal = []
+  i_pos = 0
+  for m in command_placeholder_re.finditer(t_command):
+    t_literal.append(t_command[i_pos:m.start()])
+    i_pos = m.end()
+    t_name = m.group(1)
+    if t_name == 'SAMPLE':
+      t_segments.append(''.join(t_literal))
+      t_segments.append(None)
+      t_literal = []
+    elif t_name == 'SELF':
+      t_literal.append(t_job_id)
+    elif (t_name == 'GROUP_SAMPLES') or (m.group(4) == 'INJOB_DIRS'):
+      t_segments.append(''.join(t_literal))
+      t_segments.append((m.group(4) or t_name, int(m.group(5) or 0), m.group(0)))
+      t_literal = []
+    elif (m.group(2) is not None) or (m.group(3) is not None):
+      #### longest ENV name / project job that the word starts with, rest of the word is literal
+      t_word, t_dict = (m.group(2), t_env) if m.group(2) is not None else (m.group(3), t_project_dirs)
+      t_key = longest_key_prefix(t_word, t_dict)
+      if t_key is not None:
+        t_literal.append(t_dict[t_key] + t_word[len(t_key):])
+      else:
+        t_literal.append(m.group(0))
+    elif m.group(4) == 'DATA':
+      t_segments.append(''.join(t_literal))
+      t_segments.append(int(m.group(5)))
+      t_literal = []
+    else:
+      t_values = t_injobs if m.group(4) == 'INJOBS' else t_cmd_opts
+      i = int(m.group(5))
+      t_literal.append(t_values[i] if i < len(t_values) else m.group(0))
+  t_literal.append(t_command[i_pos:])
+  t_segments.append(''.join(t_literal))
+  return t_segments
+
+
+def render_command_template(t_segments, t_sample_id, t_sample_data, t_lists=None):
+  '''command of a sample from compiled segments, $DATA.i without sample data i is left as it is
+  t_lists: {name: [list of values]} of list placeholders, values are joined by space'''
+  t_out = []
+  for t_seg in t_segments:
+    if t_seg is None:
+      t_out.append(t_sample_id)
+    elif isinstance(t_seg, int):
+      t_out.append(t_sample_data[t_seg] if t_seg < len(t_sample_data) else '$DATA.' + str(t_seg))
+    elif isinstance(t_seg, tuple):
+      t_values = t_lists.get(t_seg[0], []) if t_lists else []
+      t_out.append(' '.join(t_values[t_seg[1]]) if t_seg[1] < len(t_values) else t_seg[2])
+    else:
+      t_out.append(t_seg)
+  return ''.join(t_out)
+########## END command template
+
+
 def make_job_list(NGS_config):
   '''make sh script for each job / sample'''
 
   verify_flag = False
+  t_project_dirs = {}
+  for t_job_id in NGS_config.NGS_batch_jobs:
+    if NGS_config.NGS_batch_jobs[t_job_id].get('scope', 'sample') == 'project':
+      t_project_dirs[t_job_id] = pwd + '/' + project_sample_id + '/' + t_job_id
+  pseudo_sample_members[project_sample_id] = NGS_samples
+
   for t_job_id in NGS_config.NGS_batch_jobs:
     if subset_flag and not (t_job_id in subset_jobs):
       continue
@@ -193,15 +437,17 @@ def make_job_list(NGS_config):
     t_job = NGS_config.NGS_batch_jobs[ t_job_id ]
     t_execution = NGS_config.NGS_executions[ t_job["execution"] ]
 
-    pe_parameter = ''
-    if t_execution[ 'type' ] == 'qsub-pe':
-      t_cores_per_cmd  = t_job[ 'cores_per_cmd' ]
-      pe_parameter = "#$ -pe orte " + str(t_cores_per_cmd)
-      if 'pe_para' in t_execution.keys():
-        pe_parameter = "#$ " + t_execution[ 'pe_para' ] + " " +  str(t_cores_per_cmd)
+    pe_parameter = qsub_header(t_execution, t_job, 1)
+    t_mem_per_cmd = t_job.get('mem_per_cmd', 0)
+    t_job[ 'pe_parameter' ] = pe_parameter
 
     if t_job[ 'cores_per_cmd' ] > t_execution[ 'cores_per_node' ]:
       fatal_error('not enough cores ' + t_job_id, exit_code=1)
+    if t_mem_per_cmd > t_execution.get('mem_per_node', t_mem_per_cmd):
+      fatal_error('not enough memory ' + t_job_id, exit_code=1)
+    if (t_execution[ 'type' ] == 'sh') and \
+       (t_mem_per_cmd * t_job[ 'no_parallel' ] > t_execution.get('mem_per_node', t_mem_per_cmd * t_job[ 'no_parallel' ])):
+      fatal_error('not enough memory ' + t_job_id, exit_code=1)
 
     t_job[ 'cmds_per_node' ] = t_execution[ 'cores_per_node' ] / t_job[ 'cores_per_cmd' ]
     t_job[ 'nodes_total' ] = math.ceil( t_job[ 'no_parallel' ] / float(t_job[ 'cmds_per_node' ]))
@@ -215,41 +461,44 @@ def make_job_list(NGS_config):
     if t_job_id in NGS_opts.keys():
       CMD_opts = NGS_opts[ t_job_id ]
 
-    for t_sample_id in NGS_samples:
-      t_command = t_job[ 'command' ]
-      t_command = re.sub('\$SAMPLE', t_sample_id, t_command)
-      t_command = re.sub('\$SELF'  , t_job_id, t_command)
-
-      for i in NGS_config.ENV.keys():
-        t_command = re.sub('\$ENV.'+i, NGS_config.ENV[i], t_command)
-
-      for i_data in range(0, len(NGS_sample_data[ t_sample_id ])):
-        t_data = NGS_sample_data[ t_sample_id ][i_data]
-        t_re = '\$DATA\.' + str(i_data)
-        t_command = re.sub(t_re, t_data, t_command)
-
-      t_injobs = []
-      if 'injobs' in t_job.keys():
-        t_injobs = t_job[ 'injobs' ]
-        for i_data in range(0, len(t_job[ 'injobs' ])):
-          t_data = t_job[ 'injobs' ][i_data]
-          t_re = '\$INJOBS\.' + str(i_data)
-          t_command = re.sub(t_re, t_data, t_command)
-
-      for i_data in range(0, len(CMD_opts)):
-        t_data = CMD_opts[i_data]
-        t_re = '\$CMDOPTS\.' + str(i_data)
-        t_command = re.sub(t_re, t_data, t_command)
-
-      v_command = ''
-      if 'non_zero_files' in t_job.keys():
-        for t_data in t_job[ 'non_zero_files' ]:
-          v_command = v_command + \
-            'if ! [ -s {0}/{1} ]; then echo "zero size {2}/{3}"; exit; fi\n'.format(t_job_id, t_data, t_job_id, t_data)
+    t_injobs = []
+    if 'injobs' in t_job.keys():
+      t_injobs = t_job[ 'injobs' ]
+    t_template = compile_command_template(t_job[ 'command' ], t_job_id, NGS_config.ENV, t_injobs, CMD_opts, t_project_dirs)
+
+    t_scope = t_job.get('scope', 'sample')
+    if not t_scope in ('sample', 'project', 'group'):
+      fatal_error('unknown scope {0} of job {1}'.format(t_scope, t_job_id), exit_code=1)
+    if (t_scope == 'group') and not isinstance(t_job.get('group_by'), int):
+      fatal_error('group job {0} needs group_by, index i of sample data $DATA.i'.format(t_job_id), exit_code=1)
+    if not t_job.get('compression', 'gz') in compress_formats:
+      fatal_error('unknown compression {0} of job {1}'.format(t_job['compression'], t_job_id), exit_code=1)
+    if set(t_job.get('compress_outputs', [])) & set(t_job.get('stream_outputs', [])):
+      fatal_error('job {0}: a file can not be both in compress_outputs and stream_outputs'.format(t_job_id), exit_code=1)
+    t_stage_template = None
+    if 'stage_in' in t_job:
+      t_stage_template = compile_command_template(' '.join(t_job['stage_in']), t_job_id, NGS_config.ENV, t_injobs,
+                                                  CMD_opts, t_project_dirs)
+    t_list_placeholders = [x for x in t_template + (t_stage_template or []) if isinstance(x, tuple)]
+
+    for t_sample_id in job_samples(NGS_config, t_job_id):
+      if t_sample_id in pseudo_sample_members:
+        if t_sample_id in NGS_sample_data:
+          fatal_error('sample name {0} is reserved for project / group jobs'.format(t_sample_id), exit_code=1)
+        if not (os.path.exists(t_sample_id) or status_read_only): os.mkdir(t_sample_id)
+      #### upstream job / samples by injob, all samples of a project / group job for a sample injob
+      t_upstream_by_injob = [job_upstream(NGS_config, x, t_sample_id) for x in t_injobs]
+      t_upstream = [x for t_keys in t_upstream_by_injob for x in t_keys]
+      t_lists = None
+      if t_list_placeholders:
+        t_lists = {'INJOB_DIRS'   : [[pwd + '/' + x[1] + '/' + x[0] for x in t_keys] for t_keys in t_upstream_by_injob],
+                   'GROUP_SAMPLES': [pseudo_sample_members.get(t_sample_id, [t_sample_id])]}
+      t_command = render_command_template(t_template, t_sample_id, NGS_sample_data.get(t_sample_id, []), t_lists)
 
       f_start    = pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.start.date'
       f_complete = pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.complete.date'
       f_cpu      = pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.cpu'
+      f_exit     = pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.exit'
       t_sh_file  = '{0}/WF-sh/{1}.{2}.sh'.format(pwd, t_job_id, t_sample_id)
       t_infiles = []
       if 'infiles' in t_job.keys():
@@ -260,16 +509,304 @@ def make_job_list(NGS_config):
         'status'       : 'wait',       #### status can be wait (input not ready), ready (input ready), submitted (submitted or running), completed
         'command'      : t_command,
         'sh_file'      : t_sh_file, 
+        'execution'    : t_job['execution'],
         'infiles'      : t_infiles,
         'injobs'       : t_injobs,
+        'upstream'     : t_upstream,
         'start_file'   : f_start,
         'complete_file': f_complete,
-        'cpu_file'     : f_cpu }
+        'cpu_file'     : f_cpu,
+        'exit_file'    : f_exit }
+      if t_stage_template:
+        job_list[ t_job_id ][ t_sample_id ][ 'stage_in' ] = render_command_template(t_stage_template, t_sample_id,
+          NGS_sample_data.get(t_sample_id, []), t_lists).split()
+      job_status_count['wait'] += 1
+      job_status_by_job[t_job_id]['wait'] += 1
+      status_row_set(t_job_id, t_sample_id, 'wait')
+      jobs_dirty.add((t_job_id, t_sample_id))
+
+  make_job_dependents(NGS_config)
+  return
+### END def make_job_list(NGS_config):
+
+
+########## scatter / gather
+#### a job with 'scatter' is expanded into a split job, chunk jobs and a gather job, all scheduled as jobs
+#### NGS_batch_jobs['pfam'] = {
+####   'injobs'     : ['ORF-prediction'],
+####   'scatter'    : {'split'     : 'cd-hit-div.pl $INJOBS.0/ORF.faa $SELF/chunk $CHUNKS',
+####                   'max_chunks': 256,   #### chunk jobs defined
+####                   'chunk_size': 4},    #### MB of input per chunk
+####   'command'    : 'hmmscan ... $CHUNK > $SELF/out',       #### per chunk
+####   'gather'     : 'cat `for d in $CHUNK_DIRS; do echo $d/out; done` > $SELF/out',
+####   ...}
+#### pfam.split runs the split command, which writes input of chunk i to $SELF/chunk-i, for i < $CHUNKS
+#### pfam.chunk-0 .. pfam.chunk-255 run the command, $CHUNK is the input of the chunk, $CHUNK_ID its number
+#### pfam runs the gather command after all chunks, $CHUNK_DIRS are output dirs of the chunks,
+#### it is the job that other jobs depend on
+#### $CHUNKS is decided when the split job is ready, by size of its input, cores of the execution of chunks
+#### and max_chunks, it is kept in pfam.split/WF.chunks. chunk jobs from $CHUNKS up are completed without running
+#### split and gather run with 'execution' and 'cores_per_cmd' in 'scatter', by default the execution of the job
+#### and 1 core, chunk jobs with those of the job
+scatter_placeholder_re = re.compile(r'\$CHUNK(_DIRS|_ID|S)?(?!\w)')
+scatter_shared_keys = ('scope', 'group_by', 'CMD_opts', 'cache')
+
+def expand_scatter_jobs(NGS_config):
+  '''replace each job with 'scatter' by its split, chunk and gather jobs'''
+  NGS_batch_jobs = NGS_config.NGS_batch_jobs
+  for t_job_id in [x for x in NGS_batch_jobs.keys() if 'scatter' in NGS_batch_jobs[x]]:
+    t_job = NGS_batch_jobs[t_job_id]
+    t_scatter = t_job['scatter']
+    if not ('split' in t_scatter and 'gather' in t_job):
+      fatal_error('scatter job {0} needs split and gather commands'.format(t_job_id), exit_code=1)
+    t_split_id = t_job_id + '.split'
+    t_chunk_ids = [t_job_id + '.chunk-' + str(i) for i in range(t_scatter.get('max_chunks', 16))]
+    for j in [t_split_id] + t_chunk_ids:
+      if j in NGS_batch_jobs:
+        fatal_error('job {0} conflicts with scatter job {1}'.format(j, t_job_id), exit_code=1)
+    t_injobs = t_job.get('injobs', [])
+    t_values = {'S': '$(cat {0}/WF.chunks)'.format(t_split_id), '_DIRS': '$(cat {0}/WF.chunk_dirs)'.format(t_split_id)}
+
+    t_step = dict([(x, t_job[x]) for x in scatter_shared_keys if x in t_job])
+    t_step['execution'] = t_scatter.get('execution', t_job['execution'])
+    t_step['cores_per_cmd'] = t_scatter.get('cores_per_cmd', 1)
+    t_step['no_parallel'] = 1
+
+    NGS_batch_jobs[t_split_id] = dict(t_step)
+    NGS_batch_jobs[t_split_id].update({'injobs': t_injobs, 'infiles': t_job.get('infiles', []),
+      'command': scatter_placeholder_re.sub(lambda m: t_values.get(m.group(1), m.group(0)), t_scatter['split'])})
+
+    for i in range(len(t_chunk_ids)):
+      t_chunk = dict([(x, t_job[x]) for x in t_job.keys()
+                      if not x in ('scatter', 'gather', 'non_zero_files', 'temp_files', 'compress_outputs')])
+      t_values_i = {None: '{0}/chunk-{1}'.format(t_split_id, i), '_ID': str(i)}
+      t_chunk['injobs'] = t_injobs + [t_split_id]
+      t_chunk['infiles'] = []
+      t_chunk['command'] = scatter_placeholder_re.sub(lambda m: t_values_i.get(m.group(1), m.group(0)), t_job['command'])
+      NGS_batch_jobs[t_chunk_ids[i]] = t_chunk
+
+    t_gather = dict(t_step)
+    for x in ('non_zero_files', 'temp_files', 'compress_outputs'):
+      if x in t_job: t_gather[x] = t_job[x]
+    t_gather['injobs'] = t_injobs + [t_split_id] + t_chunk_ids
+    t_gather['command'] = scatter_placeholder_re.sub(lambda m: t_values.get(m.group(1), m.group(0)), t_job['gather'])
+    NGS_batch_jobs[t_job_id] = t_gather
+
+    if t_job_id in NGS_opts:
+      for j in [t_split_id] + t_chunk_ids: NGS_opts[j] = NGS_opts[t_job_id]
+    scatter_jobs[t_job_id] = {'split': t_split_id, 'chunks': t_chunk_ids, 'chunk_execution': t_job['execution'],
+                              'chunk_cores': t_job['cores_per_cmd'] * t_job.get('no_parallel', 1),
+                              'chunk_size': t_scatter.get('chunk_size', 0) * 1024 * 1024}
+    scatter_split_jobs[t_split_id] = t_job_id
+    scatter_chunk_jobs.update(t_chunk_ids)
+  return
+
+
+def execution_cores(NGS_config, t_execution_id):
+  '''all cores of an execution, busy or not'''
+  t_execution = NGS_config.NGS_executions[t_execution_id]
+  return t_execution['cores_per_node'] * t_execution['number_nodes']
+
+
+def scatter_input_bytes(t_job_id, t_sample_id):
+  '''size of $DATA files, infiles and output of injobs of a split job / sample'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_files = [os.path.join(pwd, t_sample_id, x) for x in NGS_sample_data.get(t_sample_id, [])]
+  t_files += [infile_path(pwd + '/' + x) or pwd + '/' + x for x in t_sample_job['infiles']]
+  for t_injob, t_sample_id_2 in t_sample_job['upstream']:
+    t_dir = pwd + '/' + t_sample_id_2 + '/' + t_injob
+    t_files += [t_dir + '/' + x for x in dir_files(t_dir)]
+  return sum([os.path.getsize(x) for x in t_files if os.path.isfile(x)])
+
+
+def scatter_plan(NGS_config, t_job_id, t_sample_id):
+  '''a split job / sample is ready, decide number of chunks, write WF.chunks and WF.chunk_dirs'''
+  t_scatter = scatter_jobs[ scatter_split_jobs[t_job_id] ]
+  t_chunks = len(t_scatter['chunks'])
+  if t_scatter['chunk_size']:
+    t_chunks = min(t_chunks, int(math.ceil(scatter_input_bytes(t_job_id, t_sample_id) / float(t_scatter['chunk_size']))))
+  #### by all cores of the execution, not the cores free at this moment, which would fix a busy moment for the run
+  t_chunks = min(t_chunks, execution_cores(NGS_config, t_scatter['chunk_execution']) / t_scatter['chunk_cores'])
+  t_chunks = max(t_chunks, 1)
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  try:
+    if not os.path.exists(t_dir): os.makedirs(t_dir)
+    open(t_dir + '/WF.chunks', 'w').write('{0}\n'.format(t_chunks))
+    open(t_dir + '/WF.chunk_dirs', 'w').write(' '.join(t_scatter['chunks'][:t_chunks]) + '\n')
+  except IOError:
+    fatal_error('cannot write to ' + t_dir, exit_code=1)
+  print '{0},{1}: {2} chunks\n'.format(t_job_id, t_sample_id, t_chunks)
+  return
+
+
+def scatter_skip_chunks(NGS_config, t_job_id, t_sample_id):
+  '''a split job / sample is completed, chunk jobs beyond WF.chunks are completed without running'''
+  t_chunk_ids = scatter_jobs[ scatter_split_jobs[t_job_id] ]['chunks']
+  try:
+    t_chunks = int(open(pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.chunks').read())
+  except (IOError, ValueError):
+    return
+  t_now = int(time.time())
+  for t_chunk_id in t_chunk_ids[t_chunks:]:
+    t_sample_job = job_list[t_chunk_id][t_sample_id]
+    if t_sample_job['status'] == 'completed': continue
+    t_dir = pwd + '/' + t_sample_id + '/' + t_chunk_id
+    if not os.path.exists(t_dir): os.makedirs(t_dir)
+    for t_file in (t_sample_job['start_file'], t_sample_job['complete_file']):
+      open(t_file, 'w').write('{0}\n'.format(t_now))
+    open(t_sample_job['exit_file'], 'w').write('exit=0 signal=0 time_end={0} host=skip pid=0\n'.format(t_now))
+    open(t_sample_job['sh_file'] + '.pids', 'w').write('skip\n')
+    t_sample_job['pids'] = ['skip']
+    t_sample_job['time_submit'] = time.time()
+    set_job_status(t_chunk_id, t_sample_id, 'completed')
+  return
+########## END scatter / gather
+
+
+########## sh files
+#### sh file of a job / sample is written just before submission, or by -J write-sh
+#### its 2nd line has a hash of the content, the file is only rewritten when the hash changes
+sh_hash_re = re.compile(r'^#### WF-sh-hash: (\w+)$', re.M)
+
+#### with 'local_scratch' of the execution, e.g. '${TMPDIR:-/tmp}', a job runs in a new dir under it:
+#### entries of the sample dir are linked, files or dirs in 'stage_in' of the job (relative to the sample dir,
+#### placeholders as in command) are copied in, the job dir is local, with a copy of files already in the job dir,
+#### e.g. WF.chunks of a scatter split job. if the command succeeds, 'stage_out' of the
+#### job (relative to the job dir, wildcards allowed, default all) is copied back in parallel, and sizes are
+#### checked before WF.complete.date is written. the scratch dir is removed on exit, also on failure
+#### a job is not run in scratch with 'local_scratch': False, or if it has stream_outputs
+scratch_sh_template = '''my_sample=__SAMPLE_DIR__
+my_scratch=$(mktemp -d __SCRATCH__/WF-__JOB__.XXXXXX 2>/dev/null)
+trap 'if [ -n "$my_scratch" ]; then rm -rf $my_scratch; fi' EXIT
+trap 'exit 143' TERM INT HUP
+
+wf_local_dir() {
+  if [ -d $my_scratch/$1 ] && ! [ -L $my_scratch/$1 ]; then return 0; fi
+  if [ "$(dirname $1)" != "." ]; then wf_local_dir $(dirname $1) || return 1; fi
+  rm -f $my_scratch/$1; mkdir $my_scratch/$1 || return 1
+  for f in $my_sample/$1/*; do if [ -e $f ]; then ln -s $f $my_scratch/$1/; fi; done
+}
+wf_stage_in() {
+  if [ "$(dirname $1)" != "." ]; then wf_local_dir $(dirname $1) || return 1; fi
+  rm -f $my_scratch/$1; cp -a $my_sample/$1 $my_scratch/$1
+}
+wf_stage_out() {
+  if [ "$1" = "." ]; then cp -a $my_scratch/__JOB__/. $my_sample/__JOB__/; return; fi
+  mkdir -p $my_sample/__JOB__/$(dirname $1) && cp -a $my_scratch/__JOB__/$1 $my_sample/__JOB__/$(dirname $1)/
+}
+wf_check_out() {
+  local t_bad=$(cd $my_scratch/__JOB__ && find $1 -type f ! -name 'WF.*' -printf '%s %p\\n' | while read -r t_size t_file; do
+    if [ "$(stat -c %s $my_sample/__JOB__/$t_file 2>/dev/null)" != "$t_size" ]; then echo $t_file; fi; done)
+  if [ -n "$t_bad" ]; then echo "size differs after copy back:" $t_bad; return 1; fi
+}
+
+if [ -z "$my_scratch" ]; then
+  echo "cannot make scratch dir under __SCRATCH__, run in $my_sample"
+__RUN__
+else
+  for f in $my_sample/*; do ln -s $f $my_scratch/; done
+  rm -f $my_scratch/__JOB__
+  if cp -a $my_sample/__JOB__ $my_scratch/__JOB__ __STAGE_IN__; then
+    cd $my_scratch
+__RUN__
+    cd $my_sample
+  else
+    echo "stage in failed"
+    my_exit=1
+  fi
+  if [ $my_exit -eq 0 ]; then
+    cd $my_scratch/__JOB__
+    for f in __STAGE_OUT__; do wf_stage_out $f & done
+    wait
+    for f in __STAGE_OUT__; do wf_check_out $f || my_exit=1; done
+    cd $my_sample
+  fi
+fi'''
+
+#### files in 'compress_outputs' of a job, relative to the job dir, are written by the command as usual, through a
+#### named pipe to pigz (gzip if no pigz) or zstd with cores_per_cmd threads; only FILE.gz or FILE.zst is kept
+#### 'compression' of the job is 'gz' (default) or 'zst'. the command must write each such file once, from start
+#### to end. downstream commands read them with wf_cat FILE, e.g. bwa mem ref <(wf_cat $INJOBS.0/R1.fa)
+#### wf_cat decompresses FILE.zst or FILE.gz, or reads FILE if it is not compressed
+compress_formats = ('gz', 'zst')
+compress_sh_functions = '''wf_cat() {
+  if [ -f $1.zst ]; then zstd -dcq $1.zst
+  elif [ -f $1.gz ]; then if command -v pigz > /dev/null; then pigz -dc $1.gz; else gzip -dc $1.gz; fi
+  else cat $1; fi
+}
+wf_compress_start() {
+  rm -f $1 $1.gz $1.zst; mkfifo $1 || return 1
+  if [ "$2" = "zst" ]; then zstd -qc -T$3 < $1 > $1.zst
+  elif command -v pigz > /dev/null; then pigz -c -p $3 < $1 > $1.gz
+  else gzip -c < $1 > $1.gz; fi &
+  wf_compress_pids="$wf_compress_pids $!"
+  wf_compress_fifos="$wf_compress_fifos $1"
+  exec {t_fd}<>$1
+  wf_compress_fds="$wf_compress_fds $t_fd"
+}
+wf_compress_close() {
+  for t_fd in $wf_compress_fds; do eval "exec $t_fd>&-"; done
+}
+wf_compress_end() {
+  local t_rc=0
+  wf_compress_close
+  for t_pid in $wf_compress_pids; do wait $t_pid || t_rc=1; done
+  rm -f $wf_compress_fifos
+  return $t_rc
+}
+'''
 
-      if not os.path.exists( t_sh_file ):
-        try:
-          tsh = open(t_sh_file, 'w')
-          tsh.write('''{0}
+def job_sh_content(NGS_config, t_job_id, t_sample_id):
+  '''sh script of a job / sample, without hash line'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_execution = NGS_config.NGS_executions[ t_job["execution"] ]
+
+  v_command = ''
+  if 'non_zero_files' in t_job.keys():
+    for t_data in t_job[ 'non_zero_files' ]:
+      if t_data in t_job.get('compress_outputs', []):  #### a compressed empty file is not of zero size
+        v_command = v_command + \
+          'if ! [ `wf_cat {0}/{1} 2>/dev/null | head -c 1 | wc -c` -eq 1 ]; then echo "zero size {0}/{1}"; exit 1; fi\n'. \
+          format(t_job_id, t_data)
+        continue
+      if t_data in t_job.get('stream_outputs', []):    #### may be a named pipe read by the downstream job
+        v_command = v_command + \
+          'if ! [ -s {0}/{1} -o -p {0}/{1} ]; then echo "zero size {0}/{1}"; exit 1; fi\n'.format(t_job_id, t_data)
+        continue
+      v_command = v_command + \
+        'if ! [ -s {0}/{1} ]; then echo "zero size {2}/{3}"; exit 1; fi\n'.format(t_job_id, t_data, t_job_id, t_data)
+
+  #### my_exit is the first non-zero status of a line of the command, caught by the ERR trap, not only the
+  #### status of its last line; non_zero_files are checked after the command succeeded
+  t_run = '''(
+my_cmd_exit=
+trap 'my_cmd_exit=${{my_cmd_exit:-$?}}' ERR
+{0}{1}
+exit ${{my_cmd_exit:-0}}
+)
+my_exit=$?'''.format('wf_compress_close\n' if t_job.get('compress_outputs') else '', t_sample_job['command'])
+  if t_job.get('compress_outputs'):
+    t_run = '''my_exit=0
+{0} || my_exit=1
+if [ $my_exit -eq 0 ]; then
+{1}
+fi
+wf_compress_end || my_exit=1'''.format(' && '.join(['wf_compress_start {0}/{1} {2} {3}'.format(t_job_id, x,
+                                       t_job.get('compression', 'gz'), t_job['cores_per_cmd']) for x in t_job['compress_outputs']]),
+                                       t_run)
+  if v_command:
+    t_run = t_run + '\nif [ $my_exit -eq 0 ]; then\n(\n{0})\nmy_exit=$?\nfi'.format(v_command)
+  if t_execution.get('local_scratch') and t_job.get('local_scratch', True) and not t_job.get('stream_outputs'):
+    t_stage_in = ''.join([' && wf_stage_in ' + x for x in t_sample_job.get('stage_in', [])])
+    t_run = scratch_sh_template.replace('__RUN__', t_run).replace('__SAMPLE_DIR__', pwd + '/' + t_sample_id). \
+            replace('__SCRATCH__', t_execution['local_scratch']).replace('__JOB__', t_job_id). \
+            replace('__STAGE_IN__', t_stage_in).replace('__STAGE_OUT__', ' '.join(t_job.get('stage_out', ['.'])))
+  #### shell functions are defined once, before the command that may be run in either branch of the scratch wrapper
+  if t_job.get('compress_outputs') or ('wf_cat' in t_sample_job['command']):
+    t_run = compress_sh_functions + t_run
+
+  return '''{0}
 {1}
 
 my_host=`hostname`
@@ -279,22 +816,718 @@ my_queue={3}
 my_time_start=`date +%s`
 
 cd {4}/{5}
-mkdir {6}
+mkdir -p {6}
 if ! [ -f {7} ]; then date +%s > {7};  fi
 {8}
-{9}
-date +%s > {10}
+my_signal=0
+if [ $my_exit -gt 128 ]; then my_signal=$((my_exit-128)); fi
+if [ $my_exit -eq 0 ]; then date +%s > {9}; fi
 my_time_end=`date +%s`;
 my_time_spent=$((my_time_end-my_time_start))
-echo "sample={5} job={6} host=$my_host pid=$my_pid queue=$my_queue cores=$my_core time_start=$my_time_start time_end=$my_time_end time_spent=$my_time_spent" >> {11}
+echo "sample={5} job={6} host=$my_host pid=$my_pid queue=$my_queue cores=$my_core time_start=$my_time_start time_end=$my_time_end time_spent=$my_time_spent" >> {10}
+echo "exit=$my_exit signal=$my_signal time_end=$my_time_end host=$my_host pid=$my_pid" >> {11}
+exit $my_exit
+
+'''.format(t_execution['template'], t_job['pe_parameter'], t_job['cores_per_cmd'], t_job['execution'], pwd, t_sample_id,
+           t_job_id, t_sample_job['start_file'], t_run, t_sample_job['complete_file'],
+           t_sample_job['cpu_file'], t_sample_job['exit_file'])
+
+
+def job_sh_hash(NGS_config, t_job_id, t_sample_id):
+  return hashlib.sha1(job_sh_content(NGS_config, t_job_id, t_sample_id)).hexdigest()
+
+
+def read_sh_hash(t_sh_file):
+  '''hash in the header of an existing sh file, None if no file or no hash'''
+  try:
+    f = open(t_sh_file, 'r')
+    t_head = f.read(4096)
+    f.close()
+  except IOError:
+    return None
+  m = sh_hash_re.search(t_head)
+  if m: return m.group(1)
+  return None
+
 
-'''.format(t_execution['template'], pe_parameter, t_job['cores_per_cmd'], t_job['execution'], pwd, t_sample_id, t_job_id, f_start, t_command, v_command, f_complete, f_cpu ))
-          tsh.close()
-          os.system('chmod u+x '+ t_sh_file)
-        except IOError:
-          fatal_error('cannot write to ' + job_list[ 't_job_id' ][ 't_sample_id' ][ 'sh_file' ], exit_code=1)
+def write_job_sh(NGS_config, t_job_id, t_sample_id):
+  '''write sh file of a job / sample if it is missing or its content changed, return the hash'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_sh_file = t_sample_job['sh_file']
+  t_content = job_sh_content(NGS_config, t_job_id, t_sample_id)
+  t_hash = hashlib.sha1(t_content).hexdigest()
+  t_sample_job['sh_hash'] = t_hash
+
+  t_old_hash = read_sh_hash(t_sh_file)
+  if t_old_hash == t_hash: return t_hash
+  if os.path.exists(t_sh_file) and (t_sample_job['status'] == 'completed'):
+    print 'Warning: {0},{1} is completed, but its sh file has changed, delete the job to run it again\n'.format(
+          t_job_id, t_sample_id)
+
+  #### hash line after #!/bin/bash of the template
+  ll = t_content.split('\n', 1)
+  if ll[0].startswith('#!'):
+    t_content = ll[0] + '\n#### WF-sh-hash: ' + t_hash + '\n' + ll[1]
+  else:
+    t_content = '#### WF-sh-hash: ' + t_hash + '\n' + t_content
+  try:
+    tsh = open(t_sh_file + '.tmp', 'w')
+    tsh.write(t_content)
+    os.fchmod(tsh.fileno(), 0755)
+    tsh.close()
+    os.rename(t_sh_file + '.tmp', t_sh_file)
+  except (IOError, OSError):
+    fatal_error('cannot write to ' + t_sh_file, exit_code=1)
+  return t_hash
+
+
+def task_write_sh(NGS_config):
+  '''write sh files of all jobs / samples by a pool of threads'''
+  t_keys = [(t_job_id, t_sample_id) for t_job_id in job_list.keys() for t_sample_id in job_list[t_job_id].keys()]
+  t_pool = ThreadPool(state_scan_threads)
+  t_pool.map(lambda t_key: write_job_sh(NGS_config, t_key[0], t_key[1]), t_keys, chunksize=64)
+  t_pool.close()
+  t_pool.join()
+  print '{0} sh files in WF-sh\n'.format(len(t_keys))
+  return
+
+
+def check_completed_sh_hash(NGS_config):
+  '''warn about completed jobs / samples whose sh file would be different now, e.g. command or CMD_opts changed'''
+  for t_job_id in job_list.keys():
+    for t_sample_id in job_list[t_job_id].keys():
+      t_sample_job = job_list[t_job_id][t_sample_id]
+      if t_sample_job['status'] != 'completed': continue
+      if not t_sample_job.get('sh_hash'): continue
+      if job_sh_hash(NGS_config, t_job_id, t_sample_id) != t_sample_job['sh_hash']:
+        print 'Warning: {0},{1} is completed, but its sh file has changed, delete the job to run it again\n'.format(
+              t_job_id, t_sample_id)
+  return
+########## END sh files
+
+
+########## output cache
+#### with --cache DIR, output of a job / sample is saved in DIR under a key, the hash of its command, CMD_opts
+#### and fingerprints (size, mtime, sampled content) of its input: $DATA files, infiles and output of injobs
+#### a job / sample with the same key, in a later run or in another project, is not run, its output dir is
+#### made from the cache by hard links (reflink or copy across file systems)
+#### files are shared by hard links, jobs should not modify their input files in place
+#### least recently used entries are removed when the cache is larger than --cache_quota
+#### a job can be excluded by 'cache': False, e.g. if its output is not determined by its input
+cache_marker_files = ('WF.start.date', 'WF.complete.date', 'WF.cpu', 'WF.exit', 'WF.temp_deleted')
+cache_sample_bytes = 65536                # bytes read at start, middle and end of a file for its fingerprint
+
+def output_cache_open():
+  '''open or create the cache index DIR/cache.db, quota is kept in the index once given'''
+  global output_cache_db, output_cache_quota
+  try:
+    if not os.path.exists(output_cache_dir + '/objects'): os.makedirs(output_cache_dir + '/objects')
+    output_cache_db = sqlite3.connect(output_cache_dir + '/cache.db', timeout=60)
+    output_cache_db.execute('PRAGMA journal_mode=WAL')
+    output_cache_db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                 key          TEXT PRIMARY KEY,
+                                 job_id       TEXT,
+                                 bytes        INTEGER,
+                                 time_created REAL,
+                                 time_used    REAL,
+                                 hits         INTEGER)''')
+    output_cache_db.execute('CREATE INDEX IF NOT EXISTS entries_time_used ON entries (time_used)')
+    output_cache_db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+    if output_cache_quota:
+      output_cache_db.execute("INSERT OR REPLACE INTO counters VALUES ('quota', ?)", (output_cache_quota,))
+    else:
+      t_row = output_cache_db.execute("SELECT value FROM counters WHERE name='quota'").fetchone()
+      if t_row: output_cache_quota = t_row[0]
+    output_cache_db.commit()
+  except (OSError, sqlite3.Error) as e:
+    fatal_error('cannot open output cache ' + output_cache_dir + ': ' + str(e), exit_code=1)
+  return
+
+
+def output_cache_count(t_name):
+  output_cache_db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (t_name,))
+  output_cache_db.execute('UPDATE counters SET value = value + 1 WHERE name=?', (t_name,))
   return
-### END def make_job_list(NGS_config):
+
+
+def file_fingerprint(t_file):
+  '''size, mtime and hash of sampled content of a file'''
+  t_stat = os.stat(t_file)
+  t_hash = hashlib.sha1('{0} {1}'.format(t_stat.st_size, int(t_stat.st_mtime)))
+  f = open(t_file, 'rb')
+  if t_stat.st_size <= 3 * cache_sample_bytes:
+    t_hash.update(f.read())
+  else:
+    for t_offset in (0, t_stat.st_size / 2, t_stat.st_size - cache_sample_bytes):
+      f.seek(t_offset)
+      t_hash.update(f.read(cache_sample_bytes))
+  f.close()
+  return t_hash.hexdigest()
+
+
+def dir_files(t_dir):
+  '''files under a job dir as relative paths, without WF.* marker files, named pipes and other special files'''
+  t_files = []
+  for t_root, t_dirs, t_names in os.walk(t_dir):
+    t_dirs.sort()
+    for t_name in sorted(t_names):
+      t_path = os.path.relpath(os.path.join(t_root, t_name), t_dir)
+      if t_path in cache_marker_files: continue
+      if not os.path.isfile(os.path.join(t_root, t_name)): continue
+      t_files.append(t_path)
+  return t_files
+
+
+def output_cache_key(NGS_config, t_job_id, t_sample_id):
+  '''cache key of a job / sample, None if the job is not cached or an input can not be read'''
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  if not t_job.get('cache', True): return None
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_sample_dir = pwd + '/' + t_sample_id
+  t_hash = hashlib.sha1()
+  t_hash.update(t_job_id + '\0' + t_sample_job['command'] + '\0')
+  t_hash.update(repr(NGS_opts.get(t_job_id, t_job.get('CMD_opts', []))) + '\0')
+  try:
+    for t_data in NGS_sample_data.get(t_sample_id, []):
+      t_file = os.path.join(t_sample_dir, t_data)
+      if os.path.isfile(t_file):
+        t_hash.update('DATA ' + t_data + ' ' + file_fingerprint(t_file) + '\0')
+    for t_file in t_sample_job['infiles']:
+      t_path = infile_path(pwd + '/' + t_file) or (pwd + '/' + t_file)
+      t_hash.update('INFILE ' + t_file + ' ' + file_fingerprint(t_path) + '\0')
+    for t_injob, t_sample_id_2 in t_sample_job['upstream']:
+      t_dir = pwd + '/' + t_sample_id_2 + '/' + t_injob
+      t_name = t_injob if t_sample_id_2 == t_sample_id else t_sample_id_2 + '/' + t_injob
+      for t_file in dir_files(t_dir):
+        t_hash.update('INJOB ' + t_name + '/' + t_file + ' ' + file_fingerprint(t_dir + '/' + t_file) + '\0')
+  except (IOError, OSError):
+    return None
+  return t_hash.hexdigest()
+
+
+def output_cache_entry(t_key):
+  return '{0}/objects/{1}/{2}'.format(output_cache_dir, t_key[:2], t_key)
+
+
+def link_tree(t_src, t_dst):
+  '''make t_dst a copy of t_src by hard links, by cp --reflink=auto if on different file systems'''
+  try:
+    for t_file in dir_files(t_src):
+      t_dir = os.path.dirname(t_dst + '/' + t_file)
+      if not os.path.exists(t_dir): os.makedirs(t_dir)
+      os.link(t_src + '/' + t_file, t_dst + '/' + t_file)
+  except OSError as e:
+    if e.errno != errno.EXDEV: raise
+    if subprocess.call(['cp', '-a', '--reflink=auto', t_src + '/.', t_dst + '/']) != 0:
+      raise OSError(errno.EIO, 'cannot copy ' + t_src)
+  return
+
+
+def output_cache_restore(NGS_config, t_job_id, t_sample_id):
+  '''a ready job / sample: if its key is in the cache, make its output from the cache and mark it completed
+  otherwise remember the key, output is saved by output_cache_save() when the job completes'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_key = output_cache_key(NGS_config, t_job_id, t_sample_id)
+  t_sample_job['cache_key'] = t_key
+  if t_key is None: return False
+  t_entry = output_cache_entry(t_key)
+  if not os.path.exists(t_entry):
+    output_cache_count('misses')
+    output_cache_db.commit()
+    return False
+
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  try:
+    if os.path.exists(t_dir): shutil.rmtree(t_dir)
+    os.makedirs(t_dir)
+    link_tree(t_entry, t_dir)
+    t_now = int(time.time())
+    for t_file in (t_sample_job['start_file'], t_sample_job['complete_file']):
+      open(t_file, 'w').write('{0}\n'.format(t_now))
+    open(t_sample_job['cpu_file'], 'a').write('sample={0} job={1} cache={2} time_end={3} time_spent=0\n'.format(
+                                              t_sample_id, t_job_id, t_key, t_now))
+    f = open(t_sample_job['exit_file'], 'w')
+    for i in range(t_job['no_parallel']):
+      f.write('exit=0 signal=0 time_end={0} host=cache pid=0\n'.format(t_now))
+    f.close()
+    open(t_sample_job['sh_file'] + '.pids', 'w').write('cache\n')
+  except (IOError, OSError) as e:
+    print 'Warning: cannot restore {0},{1} from cache: {2}\n'.format(t_job_id, t_sample_id, e)
+    return False
+
+  output_cache_db.execute('UPDATE entries SET time_used=?, hits=hits+1 WHERE key=?', (time.time(), t_key))
+  output_cache_count('hits')
+  output_cache_db.commit()
+  print '{0},{1}: output restored from cache {2}\n'.format(t_job_id, t_sample_id, t_key)
+  t_sample_job['pids'] = ['cache']
+  t_sample_job['time_submit'] = time.time()
+  set_job_status(t_job_id, t_sample_id, 'completed')
+  return True
+
+
+def output_cache_save(NGS_config, t_job_id, t_sample_id):
+  '''save output of a completed job / sample to the cache, then keep the cache within quota'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  if t_sample_job.get('pids') in (['cache'], ['skip']): return
+  if t_sample_job.get('streamed'): return          #### output or input was a named pipe
+  t_key = t_sample_job.get('cache_key') or output_cache_key(NGS_config, t_job_id, t_sample_id)
+  if t_key is None: return
+  t_entry = output_cache_entry(t_key)
+  if os.path.exists(t_entry): return
+
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  t_tmp = '{0}.tmp.{1}'.format(t_entry, os.getpid())
+  try:
+    if os.path.exists(t_tmp): shutil.rmtree(t_tmp)
+    os.makedirs(t_tmp)
+    link_tree(t_dir, t_tmp)
+    t_bytes = sum([os.path.getsize(t_tmp + '/' + x) for x in dir_files(t_tmp)])
+    os.rename(t_tmp, t_entry)
+  except (IOError, OSError) as e:
+    print 'Warning: cannot save {0},{1} to cache: {2}\n'.format(t_job_id, t_sample_id, e)
+    shutil.rmtree(t_tmp, ignore_errors=True)
+    return
+  t_now = time.time()
+  output_cache_db.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,0)', (t_key, t_job_id, t_bytes, t_now, t_now))
+  output_cache_db.commit()
+  output_cache_evict()
+  return
+
+
+def output_cache_evict():
+  '''remove least recently used entries until the cache is within quota'''
+  if not output_cache_quota: return
+  t_total = output_cache_db.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+  if t_total <= output_cache_quota: return
+  for t_key, t_bytes in output_cache_db.execute('SELECT key, bytes FROM entries ORDER BY time_used').fetchall():
+    if t_total <= output_cache_quota: break
+    shutil.rmtree(output_cache_entry(t_key), ignore_errors=True)
+    output_cache_db.execute('DELETE FROM entries WHERE key=?', (t_key,))
+    output_cache_count('evictions')
+    t_total -= t_bytes
+  output_cache_db.commit()
+  return
+
+
+def task_cache_stats():
+  '''print size, quota, hits and misses of the output cache'''
+  t_entries, t_bytes = output_cache_db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+  t_counters = dict(output_cache_db.execute('SELECT name, value FROM counters').fetchall())
+  t_hits = t_counters.get('hits', 0)
+  t_misses = t_counters.get('misses', 0)
+  print 'Output cache:\t{0}'.format(output_cache_dir)
+  print 'Entries:\t{0}'.format(t_entries)
+  print 'Size:\t{0:.1f} MB'.format(t_bytes / 1048576.0)
+  if output_cache_quota:
+    print 'Quota:\t{0:.1f} MB'.format(output_cache_quota / 1048576.0)
+  else:
+    print 'Quota:\tunlimited'
+  print 'Hits:\t{0}'.format(t_hits)
+  print 'Misses:\t{0}'.format(t_misses)
+  if t_hits + t_misses:
+    print 'Hit rate:\t{0:.1f}%'.format(100.0 * t_hits / (t_hits + t_misses))
+  print 'Evictions:\t{0}'.format(t_counters.get('evictions', 0))
+  print '\nJob\tEntries\tSize(MB)\tHits'
+  for t_job_id, t_n, t_size, t_job_hits in output_cache_db.execute(
+      'SELECT job_id, COUNT(*), SUM(bytes), SUM(hits) FROM entries GROUP BY job_id ORDER BY SUM(bytes) DESC'):
+    print '{0}\t{1}\t{2:.1f}\t{3}'.format(t_job_id, t_n, t_size / 1048576.0, t_job_hits)
+  print ''
+  return
+########## END output cache
+
+
+########## ready queue, one priority queue per execution
+#### breadth: job by job, all samples run a job before its downstream jobs, (original behavior)
+#### depth:   sample by sample, complete whole samples first to free disk and deliver results early
+#### lpt:     largest $DATA first, longest processing time first to minimize makespan
+def job_priority(t_job_id, t_sample_id):
+  '''priority tuple of a job / sample, smaller runs earlier'''
+  if not job_rank:
+    for i in range(len(job_order)):
+      job_rank[ job_order[i] ] = i
+  if schedule_policy == 'depth':
+    return (sample_index[t_sample_id], job_rank[t_job_id])
+  elif schedule_policy == 'lpt':
+    return (-get_sample_data_size(t_sample_id), job_rank[t_job_id], sample_index[t_sample_id])
+  return (job_rank[t_job_id], sample_index[t_sample_id])
+
+
+def get_sample_data_size(t_sample_id):
+  '''total size of $DATA of a sample that are files, relative paths are in the sample dir as for commands'''
+  if not t_sample_id in sample_data_size:
+    t_size = 0
+    for t_data in NGS_sample_data.get(t_sample_id, []):
+      t_file = os.path.join(pwd, t_sample_id, t_data)
+      if os.path.isfile(t_file):
+        t_size += os.path.getsize(t_file)
+    sample_data_size[t_sample_id] = t_size
+  return sample_data_size[t_sample_id]
+
+
+def ready_queue_push(t_job_id, t_sample_id):
+  t_execution_id = job_list[t_job_id][t_sample_id]['execution']
+  heapq.heappush(ready_queue[t_execution_id], (job_priority(t_job_id, t_sample_id), t_job_id, t_sample_id))
+  return
+
+
+def ready_queue_pop(t_execution_id):
+  '''pop ready job / sample with highest priority, return None if no more'''
+  t_heap = ready_queue[t_execution_id]
+  while t_heap:
+    t_priority, t_job_id, t_sample_id = heapq.heappop(t_heap)
+    if job_list[t_job_id][t_sample_id]['status'] == 'ready':
+      return (t_job_id, t_sample_id)
+  return None
+########## END ready queue
+
+
+def make_job_dependents(NGS_config):
+  '''reverse dependency index, from each job / sample to job / sample depending on it'''
+  for i in range(len(NGS_samples)):
+    sample_index[ NGS_samples[i] ] = i
+  #### project jobs first, group jobs after samples
+  for i, t_sample_id in enumerate(pseudo_sample_members.keys()):
+    sample_index[ t_sample_id ] = len(NGS_samples) + i
+  sample_index[ project_sample_id ] = -1
+  for t_job_id in job_list.keys():
+    for t_sample_id in job_list[t_job_id].keys():
+      for t_key_2 in job_list[t_job_id][t_sample_id]['upstream']:
+        job_dependents[t_key_2].append((t_job_id, t_sample_id))
+  return
+
+
+def set_job_status(t_job_id, t_sample_id, status):
+  '''change status of a job / sample, keep status counters and check lists up to date'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  old_status = t_sample_job['status']
+  if old_status == status: return
+  t_sample_job['status'] = status
+  job_status_count[old_status] -= 1
+  job_status_count[status] += 1
+  job_status_by_job[t_job_id][old_status] -= 1
+  job_status_by_job[t_job_id][status] += 1
+  status_row_set(t_job_id, t_sample_id, status)
+
+  t_key = (t_job_id, t_sample_id)
+  if status in ('submitted', 'error'): jobs_to_check.add(t_key)
+  else:                                jobs_to_check.discard(t_key)
+  if status == 'ready': ready_queue_push(t_job_id, t_sample_id)
+  if status == 'wait':  jobs_dirty.add(t_key)
+  else:                 jobs_dirty.discard(t_key)
+
+  #### only dependents of a changed job / sample need to be re-evaluated
+  for t_key_2 in job_dependents[t_key]:
+    if job_list[ t_key_2[0] ][ t_key_2[1] ]['status'] == 'wait':
+      jobs_dirty.add(t_key_2)
+  state_store_save(t_job_id, t_sample_id)
+  print '{0},{1}: change status to {2}\n'.format(t_job_id, t_sample_id, status)
+  if (status == 'completed') and (t_job_id in scatter_split_jobs) and not (state_db_loading or status_read_only):
+    scatter_skip_chunks(NGS_config, t_job_id, t_sample_id)
+  if (status == 'completed') and not (state_db_loading or status_read_only):
+    temp_files_collect(t_job_id, t_sample_id)
+  return
+
+
+def infile_path(t_file):
+  '''the non-empty file read by wf_cat for an infile: FILE.zst, FILE.gz written by compress_outputs, or FILE
+  None if none of them exists'''
+  for t_path in [t_file + '.' + x for x in reversed(compress_formats)] + [t_file]:
+    if os.path.exists(t_path) and os.path.getsize(t_path) > 0: return t_path
+  return None
+
+
+def check_job_dependency(t_job_id, t_sample_id):
+  '''check whether a waiting job / sample is ready
+  return 'ready', 'injobs' (upstream jobs not completed) or 'infiles' (input files not ready)'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  #### upstream before upstream_pos are known to be completed, a project / group job with many samples
+  #### is checked each time one of them completes, and should not scan all samples each time
+  t_upstream = t_sample_job['upstream']
+  i_pos = t_sample_job.get('upstream_pos', 0)
+  while i_pos < len(t_upstream):
+    i, t_sample_id_2 = t_upstream[i_pos]
+    if job_list[i][t_sample_id_2]['status'] != 'completed':
+      t_sample_job['upstream_pos'] = i_pos
+      return 'injobs'
+    i_pos += 1
+  t_sample_job['upstream_pos'] = i_pos
+  for i in t_sample_job['infiles']:
+    if infile_path(i) is None:
+      return 'infiles'
+  return 'ready'
+
+
+########## temporary files
+#### 'temp_files': ['R1.fa', 'tmp/*'] of a job are deleted when all downstream jobs of the job / sample
+#### are completed. names are relative to the job dir, and may have wildcards
+#### deleted files and bytes are listed in WF.temp_deleted of the job dir, the total in the job state store
+#### a job / sample whose temp files are deleted is run again if a downstream job is deleted by delete-jobs
+def temp_files_ready(t_job_id, t_sample_id):
+  '''True if temp files of a completed job / sample are no longer needed and not yet deleted'''
+  if not NGS_config.NGS_batch_jobs[t_job_id].get('temp_files'): return False
+  t_key = (t_job_id, t_sample_id)
+  if job_list[t_job_id][t_sample_id]['status'] != 'completed': return False
+  if not job_dependents[t_key]: return False
+  #### with -j, jobs outside the subset are not in job_list, they may still need the files
+  if subset_flag:
+    for t_job_id_2 in NGS_config.NGS_batch_jobs.keys():
+      if (t_job_id in NGS_config.NGS_batch_jobs[t_job_id_2].get('injobs', [])) and not (t_job_id_2 in job_list):
+        return False
+  for t_job_id_2, t_sample_id_2 in job_dependents[t_key]:
+    if job_list[t_job_id_2][t_sample_id_2]['status'] != 'completed': return False
+  return not os.path.exists(pwd + '/' + t_sample_id + '/' + t_job_id + '/WF.temp_deleted')
+
+
+def temp_files_delete(t_job_id, t_sample_id):
+  '''delete temp files of a job / sample, record them in WF.temp_deleted'''
+  global temp_bytes_deleted
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  t_deleted = []
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_patterns = t_job['temp_files']
+  if t_job.get('compress_outputs'):
+    t_patterns = t_patterns + [x + '.' + t_job.get('compression', 'gz') for x in t_patterns]
+  for t_pattern in t_patterns:
+    for t_path in sorted(glob.glob(t_dir + '/' + t_pattern)):
+      if os.path.basename(t_path) in cache_marker_files: continue
+      try:
+        if os.path.isdir(t_path) and not os.path.islink(t_path):
+          t_bytes = sum([os.path.getsize(t_path + '/' + x) for x in dir_files(t_path)])
+          shutil.rmtree(t_path)
+        else:
+          t_bytes = os.lstat(t_path).st_size
+          os.remove(t_path)
+      except OSError as e:
+        print 'Warning: cannot delete temp file {0}: {1}\n'.format(t_path, e)
+        continue
+      t_deleted.append((os.path.relpath(t_path, t_dir), t_bytes))
+  t_total = sum([x[1] for x in t_deleted])
+  f = open(t_dir + '/WF.temp_deleted', 'w')
+  for t_file, t_bytes in t_deleted:
+    f.write('{0}\t{1}\n'.format(t_file, t_bytes))
+  f.write('total\t{0}\n'.format(t_total))
+  f.close()
+  temp_bytes_deleted += t_total
+  if state_db is not None:
+    state_db.execute("INSERT OR IGNORE INTO state_info VALUES ('temp_bytes_deleted', '0')")
+    state_db.execute("UPDATE state_info SET value = CAST(value AS INTEGER) + ? WHERE key='temp_bytes_deleted'", (t_total,))
+    if not state_db_batch: state_db.commit()
+  print '{0},{1}: {2} temp files deleted, {3:.1f} MB\n'.format(t_job_id, t_sample_id, len(t_deleted), t_total / 1048576.0)
+  return
+
+
+def temp_files_collect(t_job_id, t_sample_id):
+  '''a job / sample is completed, delete temp files of its upstream jobs that are no longer needed'''
+  for t_key in job_list[t_job_id][t_sample_id]['upstream'] + [(t_job_id, t_sample_id)]:
+    if temp_files_ready(t_key[0], t_key[1]): temp_files_delete(t_key[0], t_key[1])
+  return
+
+
+def temp_files_sweep():
+  '''delete temp files no longer needed by any job, e.g. after restart'''
+  for t_job_id in job_list.keys():
+    if not NGS_config.NGS_batch_jobs[t_job_id].get('temp_files'): continue
+    for t_sample_id in job_list[t_job_id].keys():
+      if temp_files_ready(t_job_id, t_sample_id): temp_files_delete(t_job_id, t_sample_id)
+  return
+########## END temporary files
+
+
+########## job state store
+#### status, submission ids, times and resources of submitted / completed / error jobs are kept in
+#### sqlite database WF-sh/WF-state.db (WAL mode), so that restart and snapshot do not need to read
+#### WF-sh/*.pids and WF.* files of every job / sample. each state change is committed as it happens
+#### a project started by an older version of this script is scanned once from the files, in parallel
+state_db_loading = False                  # True while restoring from the store, state changes are not written back
+state_db_batch = False                    # True during bulk changes, committed once by state_store_commit()
+
+def state_store_open():
+  '''open or create the state store of this project
+  for status export it is opened read only, jobs / samples are read from files if there is no store'''
+  global state_db
+  if status_read_only:
+    if not os.path.exists(pwd + '/WF-sh/WF-state.db'): return
+    try:
+      state_db = sqlite3.connect(pwd + '/WF-sh/WF-state.db', timeout=60)
+      state_db.text_factory = str
+      state_db.execute('PRAGMA query_only=1')
+      if not 'sh_hash' in [x[1] for x in state_db.execute('PRAGMA table_info(job_state)')]: state_db = None
+    except sqlite3.Error as e:
+      fatal_error('cannot open job state store WF-sh/WF-state.db: ' + str(e), exit_code=1)
+    return
+  try:
+    state_db = sqlite3.connect(pwd + '/WF-sh/WF-state.db', timeout=60)
+    state_db.text_factory = str               #### job / sample ids as str, as in job_list, e.g. for inotify paths
+    state_db.execute('PRAGMA journal_mode=WAL')
+    state_db.execute('PRAGMA synchronous=NORMAL')
+    state_db.execute('''CREATE TABLE IF NOT EXISTS job_state (
+                          job_id      TEXT NOT NULL,
+                          sample_id   TEXT NOT NULL,
+                          status      TEXT NOT NULL,
+                          pids        TEXT,
+                          time_submit REAL,
+                          time_end    INTEGER,
+                          exit_status INTEGER,
+                          cores       INTEGER,
+                          mem         INTEGER,
+                          sh_hash     TEXT,
+                          PRIMARY KEY (job_id, sample_id))''')
+    if not 'sh_hash' in [x[1] for x in state_db.execute('PRAGMA table_info(job_state)')]:
+      state_db.execute('ALTER TABLE job_state ADD COLUMN sh_hash TEXT')
+    state_db.execute('CREATE INDEX IF NOT EXISTS job_state_status ON job_state (status)')
+    state_db.execute('CREATE TABLE IF NOT EXISTS state_info (key TEXT PRIMARY KEY, value TEXT)')
+    state_db.commit()
+  except sqlite3.Error as e:
+    fatal_error('cannot open job state store WF-sh/WF-state.db: ' + str(e), exit_code=1)
+  return
+
+
+def state_store_save(t_job_id, t_sample_id):
+  '''write state of a job / sample, called on each status change'''
+  if (state_db is None) or state_db_loading or status_read_only: return
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  if not (t_sample_job['status'] in ('submitted', 'completed', 'error')): return
+  t_cores, t_mem = local_job_resource(NGS_config.NGS_batch_jobs[t_job_id])
+  state_db.execute('INSERT OR REPLACE INTO job_state VALUES (?,?,?,?,?,?,?,?,?,?)',
+                   (t_job_id, t_sample_id, t_sample_job['status'], ' '.join(t_sample_job.get('pids', [])),
+                    t_sample_job.get('time_submit'), t_sample_job.get('time_end'), t_sample_job.get('exit_status'),
+                    t_cores, t_mem, t_sample_job.get('sh_hash')))
+  if not state_db_batch: state_db.commit()
+  return
+
+
+def state_store_forget(t_job_id, t_sample_id):
+  '''job / sample is being deleted, its files are checked again by the next restore'''
+  if (state_db is None) or status_read_only: return
+  state_db.execute("UPDATE job_state SET status='rescan' WHERE job_id=? AND sample_id=?", (t_job_id, t_sample_id))
+  if not state_db_batch: state_db.commit()
+  return
+
+
+def state_store_commit():
+  if state_db is not None: state_db.commit()
+  return
+
+
+def state_store_restore(NGS_config):
+  '''set status of jobs / samples from the state store, scan files of jobs / samples not in the store
+  if the project has never been scanned, or marked for rescan by delete-jobs
+  completed jobs / samples whose WF.complete.date was removed are forgotten, and run again
+  with status_read_only, nothing is written back, and all jobs / samples are read from files without a store'''
+  global state_db_loading, state_db_batch
+  if state_db is None:
+    state_store_rebuild(NGS_config)
+    return
+  t_rescan = []
+  t_forget = []
+  state_db_loading = True
+  for t_job_id, t_sample_id, status, pids, t_time_submit, t_time_end, t_exit, t_sh_hash in \
+      state_db.execute('SELECT job_id, sample_id, status, pids, time_submit, time_end, exit_status, sh_hash FROM job_state'):
+    if not ((t_job_id in job_list) and (t_sample_id in job_list[t_job_id])): continue
+    t_sample_job = job_list[t_job_id][t_sample_id]
+    if status == 'rescan':
+      t_rescan.append((t_job_id, t_sample_id))
+      continue
+    #### a completed job whose dir was removed by hand runs again, as after delete-jobs
+    if (status == 'completed') and not os.path.exists(t_sample_job['complete_file']):
+      print '{0},{1}: WF.complete.date is gone, the job will run again\n'.format(t_job_id, t_sample_id)
+      t_forget.append((t_job_id, t_sample_id))
+      continue
+    t_sample_job['pids'] = pids.split()
+    t_sample_job['time_submit'] = t_time_submit
+    t_sample_job['time_end'] = t_time_end
+    t_sample_job['exit_status'] = t_exit
+    t_sample_job['sh_hash'] = t_sh_hash
+    set_job_status(t_job_id, t_sample_id, status)
+  state_db_loading = False
+  for t_job_id, t_sample_id in ([] if status_read_only else t_forget):
+    state_db.execute('DELETE FROM job_state WHERE job_id=? AND sample_id=?', (t_job_id, t_sample_id))
+    try:
+      os.remove(job_list[t_job_id][t_sample_id]['sh_file'] + '.pids')
+    except OSError:
+      pass
+  if t_forget and not status_read_only: state_store_commit()
+
+  if state_db.execute("SELECT value FROM state_info WHERE key='scanned'").fetchone() is None:
+    state_store_rebuild(NGS_config)
+  elif t_rescan:
+    state_db_batch = True
+    state_store_scan(NGS_config, t_rescan)
+    state_db_batch = False
+    state_store_commit()
+
+  #### submitted jobs of an earlier run wake up the main loop when they write WF.exit
+  for t_job_id, t_sample_id in jobs_to_check:
+    if job_list[t_job_id][t_sample_id]['status'] == 'submitted': inotify_watch_job(t_job_id, t_sample_id)
+  return
+
+
+def job_marker_scan(t_key):
+  '''read .pids and exit records of a job / sample, no change to global state, run in threads'''
+  t_job_id, t_sample_id = t_key
+  t_sh_pid = job_list[t_job_id][t_sample_id]['sh_file'] + '.pids'
+  try:
+    t_mtime = os.path.getmtime(t_sh_pid)
+    f = open(t_sh_pid, 'r')
+    pids = [x.strip() for x in f if x.strip()]
+    f.close()
+  except (IOError, OSError):
+    return (t_key, None, 0, None, False, None)
+  t_records = read_job_exit_records(t_job_id, t_sample_id)
+  t_files_ok = False
+  if t_records is None: t_files_ok = validate_job_files(t_job_id, t_sample_id)
+  t_sh_hash = read_sh_hash(job_list[t_job_id][t_sample_id]['sh_file'])
+  return (t_key, pids, t_mtime, t_records, t_files_ok, t_sh_hash)
+
+
+def state_store_scan(NGS_config, t_keys):
+  '''set status of jobs / samples from WF-sh/*.pids and WF.* files, files are read by a pool of threads
+  finished jobs are completed or error, others are submitted and checked by check_submitted_job()'''
+  t_pool = None
+  if len(t_keys) > 256:         #### small projects are not worth starting threads
+    t_pool = ThreadPool(state_scan_threads)
+    t_scan = t_pool.imap_unordered(job_marker_scan, t_keys, chunksize=64)
+  else:
+    t_scan = itertools.imap(job_marker_scan, t_keys)
+  for t_key, pids, t_mtime, t_records, t_files_ok, t_sh_hash in t_scan:
+    if not pids: continue
+    t_job_id, t_sample_id = t_key
+    t_sample_job = job_list[t_job_id][t_sample_id]
+    t_sample_job['pids'] = pids
+    t_sample_job['time_submit'] = t_mtime
+    t_sample_job['sh_hash'] = t_sh_hash
+    t_job = NGS_config.NGS_batch_jobs[t_job_id]
+    if (t_records is not None) and (len(t_records) >= t_job['no_parallel']):
+      set_job_status(t_job_id, t_sample_id, job_finished_status(NGS_config, t_job_id, t_sample_id, t_records))
+    elif (t_records is None) and t_files_ok:
+      set_job_status(t_job_id, t_sample_id, 'completed')
+    else:
+      set_job_status(t_job_id, t_sample_id, 'submitted')
+  if t_pool:
+    t_pool.close()
+    t_pool.join()
+  return
+
+
+def state_store_rebuild(NGS_config):
+  '''rebuild the state store of all jobs / samples from files, with status_read_only only read the files'''
+  global state_db_batch
+  t_write = (state_db is not None) and not status_read_only
+  if t_write: print 'rebuilding job state store WF-sh/WF-state.db from files\n'
+  state_db_batch = True
+  t_keys = []
+  for t_job_id in job_list.keys():
+    for t_sample_id in job_list[t_job_id].keys():
+      t_keys.append((t_job_id, t_sample_id))
+      if t_write: state_db.execute('DELETE FROM job_state WHERE job_id=? AND sample_id=?', (t_job_id, t_sample_id))
+  state_store_scan(NGS_config, t_keys)
+  if t_write and not subset_flag:
+    state_db.execute("INSERT OR REPLACE INTO state_info VALUES ('scanned', ?)", (str(time.time()),))
+  state_db_batch = False
+  state_store_commit()
+  return
+########## END job state store
 
 
 def time_str1(s):
@@ -307,44 +1540,43 @@ def time_str1(s):
 
 
 def task_list_jobs(NGS_config):
-  for t_job_id in NGS_config.NGS_batch_jobs.keys():
+  for t_job_id in job_order:
     t_job = NGS_config.NGS_batch_jobs[t_job_id]
 
     t_injobs = []
     if 'injobs' in t_job.keys():
       t_injobs  = t_job['injobs']
-    print '{0}\tIn_jobs:[ {1} ]\tJob_level:{2}\n'.format(t_job_id, ','.join(t_injobs), t_job['job_level'] )
+    print '{0}\tIn_jobs:[ {1} ]\tJob_level:{2}\tCritical_path:{3}\n'.format(t_job_id, ','.join(t_injobs), t_job['job_level'],
+                                                                             time_str1(int(t_job['critical_path'])) )
+
+
+def snapshot_refresh(NGS_config):
+  '''job status of a project whose workflow is not running'''
+  #### completed jobs come from state store, only submitted jobs are checked
+  #### qstat is called by check_any_qsub_pids() only if there are submitted qsub jobs
+  state_store_restore(NGS_config)
+  for t_job_id, t_sample_id in list(jobs_to_check):
+    check_submitted_job(NGS_config, t_job_id, t_sample_id)
+  state_store_commit()
+  return
 
 
 def task_snapshot(NGS_config):
   '''print job status'''
-  queue_system = NGS_config.queue_system   #### default "SGE"
-  this_task = True
-  if this_task:
-    flag_qstat_xml_call = False
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      t_execution = NGS_config.NGS_executions[ t_job['execution']]
-      exe_type = t_execution['type']
-      if (queue_system == 'SGE') and (exe_type in ['qsub','qsub-pe']):
-        flag_qstat_xml_call = True
-
-    if flag_qstat_xml_call:
-      SGE_qstat_xml_query()
-
-    for t_sample_id in NGS_samples:
-      for t_job_id in NGS_config.NGS_batch_jobs.keys():
-        if subset_flag:
-          if not (t_job_id in subset_jobs):
-            continue
-        check_submitted_job(NGS_config, t_job_id, t_sample_id)
+  snapshot_refresh(NGS_config)
 
+  t_rows = NGS_samples[:]
+  for t_sample_id in pseudo_sample_members.keys():
+    if [x for x in job_list.keys() if t_sample_id in job_list[x]]:
+      t_rows.append(t_sample_id)
   max_len_sample = 0;
-  for t_sample_id in NGS_samples:
+  for t_sample_id in t_rows:
     if len(t_sample_id) > max_len_sample:
       max_len_sample = len(t_sample_id)
+  #### chunk jobs of scatter jobs are not shown, their split and gather jobs are
+  t_columns = [x for x in NGS_config.NGS_batch_jobs.keys() if not x in scatter_chunk_jobs]
   max_len_job = 0;
-  for t_job_id in NGS_config.NGS_batch_jobs.keys():
+  for t_job_id in t_columns:
     if len(t_job_id) > max_len_job:
       max_len_job = len(t_job_id)
 
@@ -358,33 +1590,26 @@ r\trunning
 x\tunselected job
 '''
 
+  #### one line is written at a time, rows are read from status_rows
+  t_lines = []
   for i1 in range(max_len_job):
     i = max_len_job - i1 - 1
-    print ' ' * max_len_sample + "\t", 
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      if i < len(t_job_id):
-        print ' ' + t_job_id[-i-1],
+    t_cells = [(' ' + x[-i-1]) if i < len(x) else '  ' for x in t_columns]
+    t_lines.append(' ' * max_len_sample + '\t' + ' '.join(t_cells) + ' ')
+  t_lines.append('Sample\t' + ('-' * 30))
+
+  for t_sample_id in t_rows:
+    t_row = status_rows.get(t_sample_id, [])
+    t_cells = []
+    for t_job_id in t_columns:
+      if subset_flag and not (t_job_id in subset_jobs):
+        t_cells.append(' x')
+      elif status_columns.get(t_job_id, len(t_row)) < len(t_row):
+        t_cells.append(' ' + t_row[status_columns[t_job_id]])
       else:
-        print '  ',
-    print ''
-  print 'Sample\t' + ('-' * 30)
-
-  for t_sample_id in NGS_samples:
-    print t_sample_id + '\t',
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      if subset_flag:
-        if not (t_job_id in subset_jobs):
-          print ' x',
-          continue
-      t_sample_job = job_list[t_job_id][t_sample_id]
-      status = t_sample_job['status']
-      if   status == 'completed': print ' +',
-      elif status == 'submitted': print ' -',
-      elif status == 'running':   print ' r',
-      elif status == 'wait':      print ' .',
-      elif status == 'error':     print ' !',
-      else:                       print ' _',
-    print ''
+        t_cells.append('  ')
+    t_lines.append(t_sample_id + '\t' + ' '.join(t_cells) + ' ')
+  print '\n'.join(t_lines)
 
   print '\n\n'
   return
@@ -404,59 +1629,68 @@ def task_delete_jobs(NGS_config, opt):
   
   tsh.write('#Please execute the following commands\n')
 
-  for t_sample_id in NGS_samples:
-    job_to_delete_ids =[]
-    if mode == 'jobids':
-      job_to_delete_ids = re.split(',', c)
-    elif mode == 'run after':
-      if not os.path.exists(c):
-        fatel_error('File does not exist:' + c, exit_code=1)
-      for t_job_id in NGS_config.NGS_batch_jobs.keys():
-        if subset_flag:
-          if not (t_job_id in subset_jobs): continue
-        t_sample_job = job_list[t_job_id][t_sample_id]
-
-        t_sh_pid  = t_sample_job['sh_file'] + '.pids'
+  t_keys = []         #### job / samples to delete
+  if mode == 'jobids':
+    for t_job_id in re.split(',', c):
+      if not t_job_id in job_list:
+        fatal_error('unknown job: ' + t_job_id, exit_code=1)
+      for t_sample_id in job_samples(NGS_config, t_job_id):
+        t_keys.append((t_job_id, t_sample_id))
+  elif mode in ('run after', 'run_after'):
+    if not os.path.exists(c):
+      fatal_error('File does not exist:' + c, exit_code=1)
+    for t_job_id in NGS_config.NGS_batch_jobs.keys():
+      if subset_flag:
+        if not (t_job_id in subset_jobs): continue
+      for t_sample_id in job_samples(NGS_config, t_job_id):
+        t_sh_pid  = job_list[t_job_id][t_sample_id]['sh_file'] + '.pids'
         if not os.path.exists(t_sh_pid): continue
         if file1_same_or_after_file2(t_sh_pid, c):
-          job_to_delete_ids.append(t_job_id)
-    else:
-      fatel_error('unknown option for deleteing jobs: ' + opt, exit_code=1)
-
-    # now job_to_delete_ids are jobs need to be deleted
-    # next find all jobs that depends on them, recrusively
-    no_jobs_to_delete = len(job_to_delete_ids)
-    while True:
-      for t_job_id in NGS_config.NGS_batch_jobs.keys():
-        if subset_flag:
-          if not (t_job_id in subset_jobs): continue
-        t_sample_job = job_list[t_job_id][t_sample_id]
-
-        t_sh_pid  = t_sample_job['sh_file'] + '.pids'
-        if not os.path.exists(t_sh_pid): continue
-
-        for t_job_id_2 in t_sample_job['injobs']:
-          if t_job_id_2 in job_to_delete_ids:
-            if not t_job_id in job_to_delete_ids:
-              job_to_delete_ids.append(t_job_id)
-
-      if no_jobs_to_delete == len(job_to_delete_ids): break
-      no_jobs_to_delete = len(job_to_delete_ids)
-
-    if not no_jobs_to_delete: continue
+          t_keys.append((t_job_id, t_sample_id))
+  else:
+    fatal_error('unknown option for deleteing jobs: ' + opt, exit_code=1)
+
+  # now t_keys are jobs need to be deleted
+  # next find all started jobs that depends on them, recrusively, for a project job in all samples
+  t_seen = set(t_keys)
+  i = 0
+  while i < len(t_keys):
+    for t_key_2 in job_dependents[t_keys[i]]:
+      if t_key_2 in t_seen: continue
+      if not os.path.exists(job_list[ t_key_2[0] ][ t_key_2[1] ]['sh_file'] + '.pids'): continue
+      t_seen.add(t_key_2)
+      t_keys.append(t_key_2)
+    i += 1
+
+  #### upstream jobs whose temp files are deleted, or whose outputs were streamed and are left as named pipes,
+  #### run again, to make the files for the deleted jobs
+  for t_key in list(t_keys):
+    for t_key_2 in job_list[ t_key[0] ][ t_key[1] ]['upstream']:
+      if t_key_2 in t_seen: continue
+      if os.path.exists(pwd + '/' + t_key_2[1] + '/' + t_key_2[0] + '/WF.temp_deleted') or \
+         stream_fifo_left(t_key_2[0], t_key_2[1]):
+        t_seen.add(t_key_2)
+        t_keys.append(t_key_2)
+
+  t_sample_jobs = collections.defaultdict(list)
+  for t_job_id, t_sample_id in t_keys:
+    t_sample_jobs[t_sample_id].append(t_job_id)
+
+  for t_sample_id in NGS_samples + pseudo_sample_members.keys():
+    job_to_delete_ids = t_sample_jobs[t_sample_id]
+    if not job_to_delete_ids: continue
     tsh.write('#jobs to be deleted for ' + t_sample_id + ': ' + ' '.join(job_to_delete_ids) + '\n'), 
 
     for t_job_id in job_to_delete_ids:
       t_sample_job = job_list[t_job_id][t_sample_id]
       t_sh_pid  = t_sample_job['sh_file'] + '.pids'
       tsh.write('\\rm -rf {0}/{1}\n'.format(t_sample_id, t_job_id))
+      state_store_forget(t_job_id, t_sample_id)
+      if not os.path.exists(t_sh_pid): continue
       tsh.write('\\rm '+ t_sh_pid + '\n')
 
       t_job = NGS_config.NGS_batch_jobs[t_job_id]
       t_execution = NGS_config.NGS_executions[ t_job['execution']]
-      kill_cmd = 'qdel '
-      if (t_execution['type'] == 'sh'):
-        kill_cmd = 'kill '
 
       #### find the qsub ids to be deleted 
       pids = [] #### either pids, or qsub ids
@@ -467,10 +1701,19 @@ def task_delete_jobs(NGS_config, opt):
         pids = [x.strip() for x in pids]
       except IOError:
         fatal_error('cannot open ' + t_sh_pid, exit_code=1)
-      tsh.write(kill_cmd + ' '.join([str(x) for x in pids]) + '\n')
+      pids = [x for x in pids if not x in ('cache', 'skip')]
+      if not pids: continue
+      if (t_execution['type'] == 'sh'):
+        #### each local job runs in its own process group, kill the group
+        tsh.write('kill -- ' + ' '.join(['-' + str(x) for x in pids]) + '\n')
+      else:
+        #### array job tasks as jobid.taskid
+        for x in pids:
+          tsh.write(queue_backends[queue_system]['cancel'](x) + '\n')
 
     tsh.write('\n\n')
   tsh.close()
+  state_store_commit()
   print 'The script does not delete the files, please run ' + tmp_sh + ' to delete files!!!\n\n';
   return
 #### END def task_delete_jobs()
@@ -486,238 +1729,1343 @@ def file1_same_or_after_file2(file1, file2):
   else:                                                  return False
 
 
-def SGE_qstat_xml_query():
-  '''run qstat -f -xml and get xml tree'''
-  global qstat_xml_data
-  qstat_xml_data = collections.defaultdict(dict)
-  t_out = ''
+########## batch system backends
+#### qsub / qsub-pe executions go through the backend selected by -Q or queue_system in configration file
+#### each backend in queue_backends provides
+####   submit(t_execution, t_name, t_stderr, t_stdout, t_sh, t_array_size=0): submit a script, return job id,
+####                                   array job of tasks 1..t_array_size if t_array_size > 0
+####   status(NGS_config):             {job id or jobid.taskid: [name, state]} of queued or running jobs
+####   cancel(pid):                    command line to delete job id or jobid.taskid
+####   accounting(pid):                exit status of a finished job, None if not known
+####   header(t_execution, t_job, t_no_cmds): cores and memory request lines of the script
+####   task_id:                        environment variable of the task id of an array job
+def queue_users(NGS_config):
+  '''users whose jobs are queried, 'user' of executions or the current user'''
+  t_users = []
+  for t_execution in NGS_config.NGS_executions.values():
+    if not (t_execution['type'] in ['qsub', 'qsub-pe']): continue
+    t_user = t_execution.get('user', getpass.getuser())
+    if not t_user in t_users: t_users.append(t_user)
+  if not t_users: t_users.append(getpass.getuser())
+  return t_users
+
+
+def queue_submit_command(command_line):
+  '''run a submit command, return the first number in its output as job id'''
+  try:
+    cmd = subprocess.check_output(command_line, close_fds=True)
+  except (OSError, subprocess.CalledProcessError):
+    fatal_error('error submitting jobs: ' + ' '.join(command_line))
+  if re.search('\d+', cmd):
+    return re.search('\d+', cmd).group(0)
+  fatal_error('error submitting jobs: ' + ' '.join(command_line))
+
+
+def queue_accounting_command(command_line):
+  '''output of an accounting command, None if it fails'''
+  try:
+    return subprocess.check_output(command_line, stderr=open(os.devnull, 'w'), close_fds=True)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+#### SGE
+def SGE_submit(t_execution, t_name, t_stderr, t_stdout, t_sh, t_array_size=0):
+  command_line = [t_execution.get('qsub_exe', 'qsub')]
+  if t_array_size: command_line += ['-t', '1-{0}'.format(t_array_size)]
+  command_line += [t_execution.get('command_name_opt', '-N'), t_name,
+                   t_execution.get('command_err_opt', '-e'), t_stderr,
+                   t_execution.get('command_out_opt', '-o'), t_stdout, t_sh]
+  return queue_submit_command(command_line)
+
+
+def SGE_status(NGS_config):
+  '''run qstat -xml for users of the executions, parse the xml as a stream'''
+  t_status = {}
   try:
-    t_out  = subprocess.check_output(['qstat -f -xml'], shell=True)
-  except:
+    p = subprocess.Popen(['qstat', '-xml', '-u', ','.join(queue_users(NGS_config))], stdout=subprocess.PIPE, close_fds=True)
+    t_root = None
+    for event, elem in ET.iterparse(p.stdout, events=('start', 'end')):
+      if event == 'start':
+        if t_root is None: t_root = elem
+        continue
+      if elem.tag != 'job_list': continue
+      job_id    = elem.findtext('JB_job_number')
+      job_name  = elem.findtext('JB_name')
+      job_state = elem.findtext('state')
+      t_status[job_id] = [job_name, job_state]
+      job_tasks = elem.findtext('tasks')       #### array job, running task or range of pending tasks
+      if job_tasks:
+        for t_task in SGE_expand_tasks(job_tasks):
+          t_status[job_id + '.' + t_task] = [job_name, job_state]
+      elem.clear()
+      t_root.clear()                           #### drop parsed job_list from the tree
+    if p.wait() != 0: raise OSError
+  except (OSError, ET.ParseError):
     fatal_error("can not run qstat", exit_code=1)
+  return t_status
+
+
+def SGE_expand_tasks(tasks):
+  '''expand SGE task list e.g. 1-10:1,15 into ['1','2',...,'10','15']'''
+  t_ids = []
+  for t_range in re.split(',', tasks.strip()):
+    m = re.match('^(\d+)-(\d+)(:(\d+))?$', t_range)
+    if m:
+      t_step = int(m.group(4)) if m.group(4) else 1
+      t_ids.extend([str(i) for i in range(int(m.group(1)), int(m.group(2)) + 1, t_step)])
+    elif re.match('^\d+$', t_range):
+      t_ids.append(t_range)
+  return t_ids
+
+
+def SGE_cancel(pid):
+  '''qdel jobid, or qdel jobid -t taskid for a task of an array job'''
+  return 'qdel ' + ' -t '.join(re.split('\.', pid))
+
+
+def SGE_accounting(pid):
+  ll = re.split('\.', pid)
+  t_out = queue_accounting_command(['qacct', '-j', ll[0]] + (['-t', ll[1]] if len(ll) > 1 else []))
+  if t_out:
+    m = re.search('^exit_status\s+(\d+)', t_out, re.M)
+    if m: return int(m.group(1))
+  return None
+
+
+def SGE_header(t_execution, t_job, t_no_cmds):
+  pe_parameter = ''
+  t_cores = t_job[ 'cores_per_cmd' ] * t_no_cmds
+  if t_execution[ 'type' ] == 'qsub-pe':
+    pe_parameter = "#$ -pe orte " + str(t_cores)
+    if 'pe_para' in t_execution.keys():
+      pe_parameter = "#$ " + t_execution[ 'pe_para' ] + " " +  str(t_cores)
+
+  #### memory request, SGE h_vmem and mem_free are per slot for parallel environment
+  t_mem_per_cmd = t_job.get('mem_per_cmd', 0)
+  if t_mem_per_cmd and (t_execution[ 'type' ] in ['qsub', 'qsub-pe']):
+    t_mem_per_slot = t_mem_per_cmd * t_no_cmds
+    if t_execution[ 'type' ] == 'qsub-pe':
+      t_mem_per_slot = int(math.ceil( t_mem_per_cmd / float(t_job[ 'cores_per_cmd' ])))
+    pe_parameter = pe_parameter + "\n#$ -l h_vmem={0}M,mem_free={0}M".format(t_mem_per_slot)
+  return pe_parameter
+
+
+#### Slurm
+def SLURM_submit(t_execution, t_name, t_stderr, t_stdout, t_sh, t_array_size=0):
+  command_line = [t_execution.get('sbatch_exe', 'sbatch'), '--parsable']
+  if t_array_size: command_line += ['--array=1-{0}'.format(t_array_size)]
+  command_line += ['-J', t_name, '-e', t_stderr, '-o', t_stdout, t_sh]
+  return queue_submit_command(command_line)
 
-  qstat_xml_root = ET.fromstring(t_out)
-  #qstat_xml_root = qstat_xml.getroot()
-  for job_list in qstat_xml_root.iter('job_list'):
-    job_id    = job_list.find('JB_job_number').text
-    job_name  = job_list.find('JB_name').text
-    job_state = job_list.find('state').text
-    qstat_xml_data[job_id] = [job_name, job_state]
 
+def SLURM_number(value):
+  '''squeue --json gives numbers either as int or as {"set": true, "number": int}'''
+  if isinstance(value, dict): return value.get('number')
+  return value
+
+
+def SLURM_status(NGS_config):
+  '''run squeue --json for users of the executions, pending array tasks are listed as jobid.taskid
+  squeue --json ignores -u in some versions of slurm, jobs of other users are skipped here'''
+  t_status = {}
+  t_users = queue_users(NGS_config)
+  try:
+    t_out = subprocess.check_output(['squeue', '--json', '-u', ','.join(t_users)], close_fds=True)
+    t_jobs = json.loads(t_out).get('jobs', [])
+  except (OSError, subprocess.CalledProcessError, ValueError):
+    fatal_error("can not run squeue", exit_code=1)
+
+  for t_job in t_jobs:
+    if not t_job.get('user_name', t_users[0]) in t_users: continue
+    job_name  = t_job.get('name', '')
+    job_state = t_job.get('job_state', '')
+    if isinstance(job_state, list): job_state = ','.join(job_state)
+    t_array_id = SLURM_number(t_job.get('array_job_id'))
+    if t_array_id:
+      t_task_id = SLURM_number(t_job.get('array_task_id'))
+      t_status[str(t_array_id)] = [job_name, job_state]
+      if t_task_id is not None:
+        t_status['{0}.{1}'.format(t_array_id, t_task_id)] = [job_name, job_state]
+      t_tasks = t_job.get('array_task_string', '')   #### pending tasks e.g. 1-10,15 or 1-10%2
+      if t_tasks:
+        for t_task in SGE_expand_tasks(re.sub('%\d+', '', t_tasks)):
+          t_status['{0}.{1}'.format(t_array_id, t_task)] = [job_name, job_state]
+    else:
+      t_status[str(SLURM_number(t_job.get('job_id')))] = [job_name, job_state]
+  return t_status
+
+
+def SLURM_cancel(pid):
+  return 'scancel ' + '_'.join(re.split('\.', pid))
+
+
+def SLURM_accounting(pid):
+  t_out = queue_accounting_command(['sacct', '-j', '_'.join(re.split('\.', pid)), '-n', '-P', '-X', '-o', 'State,ExitCode'])
+  if t_out:
+    for line in t_out.splitlines():
+      ll = re.split('\|', line)
+      if len(ll) < 2: continue
+      if not re.match('^\d+:\d+$', ll[1]): continue
+      t_exit, t_signal = [int(x) for x in re.split(':', ll[1])]
+      return t_exit if t_exit else (128 + t_signal if t_signal else 0)
+  return None
+
+
+def SLURM_header(t_execution, t_job, t_no_cmds):
+  pe_parameter = ''
+  if t_execution[ 'type' ] == 'qsub-pe':
+    pe_parameter = "#SBATCH --cpus-per-task=" + str(t_job[ 'cores_per_cmd' ] * t_no_cmds)
+  t_mem_per_cmd = t_job.get('mem_per_cmd', 0)
+  if t_mem_per_cmd:
+    pe_parameter = pe_parameter + "\n#SBATCH --mem={0}M".format(t_mem_per_cmd * t_no_cmds)
+  return pe_parameter
+
+
+#### PBS Pro
+def PBS_submit(t_execution, t_name, t_stderr, t_stdout, t_sh, t_array_size=0):
+  command_line = [t_execution.get('qsub_exe', 'qsub')]
+  if t_array_size: command_line += ['-J', '1-{0}'.format(t_array_size)]
+  command_line += ['-N', t_name, '-e', t_stderr, '-o', t_stdout, t_sh]
+  return queue_submit_command(command_line)
+
+
+def PBS_status(NGS_config):
+  '''run qstat -f -F json -t for the jobs submitted by this workflow, qstat -f can not be limited by -u
+  keep jobs of users of the executions, array tasks 123[4].server as 123.4'''
+  t_status = {}
+  t_users = queue_users(NGS_config)
+  t_ids = {}
+  for t_job_id, t_sample_id in jobs_to_check:
+    t_sample_job = job_list[t_job_id][t_sample_id]
+    if t_sample_job['status'] != 'submitted': continue
+    if not (NGS_config.NGS_executions[ t_sample_job['execution'] ]['type'] in ['qsub', 'qsub-pe']): continue
+    for pid in t_sample_job.get('pids', []):
+      ll = re.split('\.', pid)
+      t_ids[ ll[0] ] = t_ids.get(ll[0], False) or (len(ll) > 1)
+  if not t_ids: return t_status
+  #### qstat exits non-zero if some jobs are finished, jobs still known are printed
+  try:
+    p = subprocess.Popen(['qstat', '-f', '-F', 'json', '-t'] + sorted([x + '[]' if t_ids[x] else x for x in t_ids]),
+                         stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'), close_fds=True)
+    t_out = p.communicate()[0]
+  except OSError:
+    fatal_error("can not run qstat", exit_code=1)
+  try:
+    t_jobs = json.loads(t_out).get('Jobs', {}) if t_out.strip() else {}
+  except ValueError:
+    fatal_error("can not parse output of qstat", exit_code=1)
+
+  for t_pbs_id, t_job in t_jobs.items():
+    if not re.split('@', t_job.get('Job_Owner', ''))[0] in t_users: continue
+    m = re.match('^(\d+)(\[(\d*)\])?', t_pbs_id)
+    if not m: continue
+    job_id = m.group(1)
+    if m.group(3): job_id = job_id + '.' + m.group(3)
+    t_status[job_id] = [t_job.get('Job_Name', ''), t_job.get('job_state', '')]
+  return t_status
+
+
+def PBS_cancel(pid):
+  ll = re.split('\.', pid)
+  if len(ll) > 1: return 'qdel {0}[{1}]'.format(ll[0], ll[1])
+  return 'qdel ' + pid
+
+
+def PBS_accounting(pid):
+  ll = re.split('\.', pid)
+  t_pbs_id = '{0}[{1}]'.format(ll[0], ll[1]) if len(ll) > 1 else pid
+  t_out = queue_accounting_command(['qstat', '-x', '-f', '-F', 'json', t_pbs_id])
+  if t_out:
+    try:
+      for t_job in json.loads(t_out).get('Jobs', {}).values():
+        if 'Exit_status' in t_job: return int(t_job['Exit_status'])
+    except ValueError:
+      pass
+  return None
+
+
+def PBS_header(t_execution, t_job, t_no_cmds):
+  t_select = "#PBS -l select=1:ncpus=" + str(t_job[ 'cores_per_cmd' ] * t_no_cmds)
+  t_mem_per_cmd = t_job.get('mem_per_cmd', 0)
+  if t_mem_per_cmd:
+    t_select = t_select + ":mem={0}MB".format(t_mem_per_cmd * t_no_cmds)
+  return t_select
+
+
+#### fake batch system, runs jobs on this computer, for testing workflows without a cluster
+#### a job is a setsid bash process; WF-sh/fake-queue/<id>.run exists while it is queued or running,
+#### <id>.exit has its exit status. 'fake_latency' of an execution delays the start of its jobs (seconds)
+def FAKE_spool():
+  t_spool = pwd + '/WF-sh/fake-queue'
+  if not os.path.exists(t_spool): os.makedirs(t_spool)
+  return t_spool
+
+
+def FAKE_submit(t_execution, t_name, t_stderr, t_stdout, t_sh, t_array_size=0):
+  t_spool = FAKE_spool()
+  t_id = str(int(time.time() * 1000) % 100000000)
+  while os.path.exists(t_spool + '/' + t_id + '.run') or os.path.exists(t_spool + '/' + t_id + '.exit'):
+    t_id = str(int(t_id) + 1)
+  t_tasks = [(t_id, '')]
+  if t_array_size:
+    t_tasks = [('{0}.{1}'.format(t_id, i), str(i)) for i in range(1, t_array_size + 1)]
+  for t_task, i in t_tasks:
+    open(t_spool + '/' + t_task + '.run', 'w').write(t_name + '\n')
+
+  t_runner = ['sleep {0}'.format(t_execution.get('fake_latency', 0))]
+  #### each task runs in its own session, <id>.pid has its process group, killed by FAKE_cancel()
+  for t_task, i in t_tasks:
+    t_runner.append(('( WF_TASK_ID={0} setsid /bin/bash {1} >>{2} 2>>{3} & echo $! >{4}/{5}.pid; wait $!; ' +
+                     'echo $? >{4}/{5}.exit; rm -f {4}/{5}.run {4}/{5}.pid ) &').format(
+                     i, t_sh, t_stdout, t_stderr, t_spool, t_task))
+  t_runner.append('wait')
+  local_spawn(['-c', '\n'.join(t_runner)], os.devnull)
+  return t_id
+
+
+def FAKE_status(NGS_config):
+  t_status = {}
+  t_spool = FAKE_spool()
+  for t_file in os.listdir(t_spool):
+    if not t_file.endswith('.run'): continue
+    job_id = t_file[:-4]
+    t_status[job_id] = ['', 'r']
+    if '.' in job_id: t_status[ re.split('\.', job_id)[0] ] = ['', 'r']
+  return t_status
+
+
+def FAKE_cancel(pid):
+  '''kill process groups of the job, or of all tasks of an array job'''
+  t_pid_files = '{0}/{1}.pid {0}/{1}.*.pid'.format(FAKE_spool(), pid)
+  return 'for f in {0}; do if [ -f $f ]; then kill -- -`cat $f`; fi; done'.format(t_pid_files)
+
+
+def FAKE_accounting(pid):
+  try:
+    return int(open(FAKE_spool() + '/' + pid + '.exit').read())
+  except (IOError, ValueError):
+    return None
+
+
+queue_backends = {
+  'SGE'  : {'submit': SGE_submit,   'status': SGE_status,   'cancel': SGE_cancel,   'accounting': SGE_accounting,
+            'header': SGE_header,   'task_id': 'SGE_TASK_ID'},
+  'SLURM': {'submit': SLURM_submit, 'status': SLURM_status, 'cancel': SLURM_cancel, 'accounting': SLURM_accounting,
+            'header': SLURM_header, 'task_id': 'SLURM_ARRAY_TASK_ID'},
+  'PBS'  : {'submit': PBS_submit,   'status': PBS_status,   'cancel': PBS_cancel,   'accounting': PBS_accounting,
+            'header': PBS_header,   'task_id': 'PBS_ARRAY_INDEX'},
+  'FAKE' : {'submit': FAKE_submit,  'status': FAKE_status,  'cancel': FAKE_cancel,  'accounting': FAKE_accounting,
+            'header': SGE_header,   'task_id': 'WF_TASK_ID'},
+}
+
+
+def queue_status_query(NGS_config):
+  '''query queued and running jobs from the batch system, save to cache file
+  the status is as of the time the query started, a job submitted after that may be missing from it'''
+  global qstat_xml_data, qstat_xml_time
+  t_start = time.time()
+  qstat_xml_data = collections.defaultdict(dict)
+  qstat_xml_data.update(queue_backends[queue_system]['status'](NGS_config))
+  qstat_xml_time = t_start
+  if not status_read_only: queue_status_cache_write()
   return
-#### END def SGE_qstat_xml_query()
+
+
+def queue_status_cache_write():
+  '''write batch system status to cache file, atomically, so snapshot can reuse it'''
+  t_cache = pwd + '/WF-sh/qstat.cache'
+  try:
+    f = open(t_cache + '.tmp', 'w')
+    f.write(repr(qstat_xml_time) + '\n')          #### full precision, str() rounds to 10 ms in python 2
+    for job_id in qstat_xml_data.keys():
+      f.write('\t'.join([job_id] + qstat_xml_data[job_id]) + '\n')
+    f.close()
+    os.rename(t_cache + '.tmp', t_cache)
+  except (IOError, OSError):
+    pass
+  return
+
+
+def queue_status_cache_read():
+  '''read batch system status from cache file if it is not older than qstat_ttl'''
+  global qstat_xml_data, qstat_xml_time
+  t_cache = pwd + '/WF-sh/qstat.cache'
+  try:
+    f = open(t_cache, 'r')
+    t_time = float(f.readline())
+    if time.time() - t_time > qstat_ttl:
+      f.close()
+      return False
+    qstat_xml_data = collections.defaultdict(dict)
+    for line in f:
+      ll = line.rstrip('\n').split('\t')
+      qstat_xml_data[ ll[0] ] = ll[1:]
+    f.close()
+  except (IOError, ValueError):
+    return False
+  qstat_xml_time = t_time
+  return True
+
+
+def queue_status_invalidate():
+  '''forget batch system status in memory and in cache file, e.g. after a job finished'''
+  global qstat_xml_time
+  qstat_xml_time = 0
+  try:
+    os.remove(pwd + '/WF-sh/qstat.cache')
+  except OSError:
+    pass
+  return
+
+
+def queue_status_data(NGS_config, t_since=0):
+  '''batch system status not older than qstat_ttl and newer than t_since (e.g. time of submission),
+  from memory, from cache file, or from a new query'''
+  if (time.time() - qstat_xml_time <= qstat_ttl) and (qstat_xml_time > t_since): return qstat_xml_data
+  if queue_status_cache_read() and (qstat_xml_time > t_since): return qstat_xml_data
+  queue_status_query(NGS_config)
+  return qstat_xml_data
+########## END batch system backends
 
 
 def print_job_status_summary(NGS_config):
   '''print jobs status'''
-  job_status = {}
-  job_total = 0
-
-  for t_job_id in NGS_config.NGS_batch_jobs.keys():
-    if subset_flag:
-      if not (t_job_id in subset_jobs):
-        continue
-    for t_sample_id in NGS_samples:
-      status = job_list[t_job_id][t_sample_id]['status']
-      if status in job_status.keys():
-        job_status[status] +=1
-      else:
-        job_status[status] =1
-      job_total +=1
+  job_total = sum(job_status_count.values())
 
   print 'total jobs: {0},'.format(job_total) , 
-  for i in job_status.keys():
-    print '{0}: {1}, '.format(i, job_status[i]), 
+  for i in job_status_count.keys():
+    if job_status_count[i] == 0: continue
+    print '{0}: {1}, '.format(i, job_status_count[i]), 
+  if temp_bytes_deleted:
+    print 'temp files deleted: {0:.1f} MB'.format(temp_bytes_deleted / 1048576.0),
   print '\n'
 
 
+########## status file
+#### the running workflow writes its job status to WF-sh/WF-status.json after status changes, at most once
+#### per status_publish_interval, and at least once per status_heartbeat. the file is replaced atomically
+#### -J watch and -J snapshot --format read it, so they do not call qstat or read files of jobs
+#### per sample status is kept as a string, one char per job of "columns", as in -J snapshot
+status_file = 'WF-sh/WF-status.json'
+status_names = ('wait', 'ready', 'submitted', 'completed', 'error')
+status_chars = {'wait': '.', 'ready': '_', 'submitted': '-', 'running': 'r', 'completed': '+', 'error': '!'}
+status_publish_interval = 1               # seconds
+status_heartbeat = 60                     # seconds
+status_published = (-1, 0)                # status_changes and time of the last write
+
+def status_row_set(t_job_id, t_sample_id, status):
+  '''keep status char of a job / sample in status_rows'''
+  global status_changes
+  if not t_job_id in status_columns: status_columns[t_job_id] = len(status_columns)
+  i = status_columns[t_job_id]
+  t_row = status_rows.setdefault(t_sample_id, [])
+  if len(t_row) <= i: t_row.extend([' '] * (i + 1 - len(t_row)))
+  t_row[i] = status_chars.get(status, '_')
+  status_changes += 1
+  return
+
+
+def status_data():
+  '''job status counts, by job and by status, and per sample status
+  jobs in order of job_order, chunk jobs of scatter jobs are not included, as in -J snapshot'''
+  t_columns = [x for x in job_order if (x in status_columns) and not (x in scatter_chunk_jobs)]
+  t_index = [status_columns[x] for x in t_columns]
+  t_samples = collections.OrderedDict()
+  for t_sample_id in [x for x in NGS_samples + pseudo_sample_members.keys() if x in status_rows]:
+    t_row = status_rows[t_sample_id]
+    t_samples[t_sample_id] = ''.join([t_row[i] if i < len(t_row) else ' ' for i in t_index])
+  t_jobs = collections.OrderedDict()
+  t_count = collections.Counter()
+  for t_job_id in t_columns:
+    t_jobs[t_job_id] = dict([x for x in job_status_by_job[t_job_id].items() if x[1]])
+    t_count.update(t_jobs[t_job_id])
+  return {'total'             : sum(t_count.values()),
+          'status'            : dict(t_count),
+          'jobs'              : t_jobs,
+          'temp_bytes_deleted': temp_bytes_deleted,
+          'columns'           : t_columns,
+          'samples'           : t_samples}
+
+
+def status_publish(t_finished=False):
+  '''write WF-sh/WF-status.json if status changed, through a temp file and rename'''
+  global status_published
+  t_now = time.time()
+  if not t_finished:
+    if (status_published[0] == status_changes) and (t_now - status_published[1] < status_heartbeat): return
+    if t_now - status_published[1] < status_publish_interval: return
+  t_status = status_data()
+  t_status.update({'time': t_now, 'host': socket.gethostname(), 'pid': os.getpid(), 'finished': t_finished})
+  t_file = pwd + '/' + status_file
+  try:
+    f = open(t_file + '.tmp', 'w')
+    json.dump(t_status, f, separators=(',', ':'))
+    f.close()
+    os.rename(t_file + '.tmp', t_file)
+  except (IOError, OSError) as e:
+    print 'Warning: cannot write {0}: {1}\n'.format(status_file, e)
+  status_published = (status_changes, t_now)
+  return
+
+
+def status_read(t_live=False):
+  '''status from WF-sh/WF-status.json, None if it can not be read
+  t_live: None also if the workflow that wrote it is finished or no longer running'''
+  try:
+    f = open(pwd + '/' + status_file, 'r')
+    t_status = json.load(f, object_pairs_hook=collections.OrderedDict)
+    f.close()
+  except (IOError, ValueError):
+    return None
+  if t_live:
+    if t_status['finished']: return None
+    if t_status['host'] == socket.gethostname():
+      if not check_pid(t_status['pid']): return None
+    elif time.time() - t_status['time'] > status_heartbeat + poll_interval_max:
+      return None
+  return t_status
+
+
+def status_print(t_status, t_format, t_detail=False, t_indent=1):
+  '''print status from status_data() or status_read() as json, tsv or text
+  t_detail: also status of each job / sample'''
+  t_columns = t_status['columns']
+  t_names = list(status_names) + sorted([x for x in t_status['status'].keys() if not x in status_names])
+  if t_format == 'json':
+    t_out = collections.OrderedDict([x for x in t_status.items() if not x[0] in ('columns', 'samples')])
+    if t_detail:
+      t_chars = dict([(y, x) for x, y in status_chars.items()])
+      t_out['samples'] = collections.OrderedDict()
+      for t_sample_id, t_row in t_status['samples'].items():
+        t_out['samples'][t_sample_id] = collections.OrderedDict(
+          [(t_columns[i], t_chars.get(t_row[i], 'ready')) for i in range(len(t_columns)) if t_row[i] != ' '])
+    print json.dumps(t_out, indent=t_indent, separators=(',', ': ') if t_indent else (',', ':'))
+  elif t_format == 'tsv':
+    #### the last row, *, is the total of all jobs, * can not be a job id
+    print '\t'.join(['job'] + t_names + ['total'])
+    for t_job_id in t_columns + [None]:
+      t_count = t_status['jobs'][t_job_id] if t_job_id else t_status['status']
+      print '\t'.join([t_job_id or '*'] + [str(t_count.get(x, 0)) for x in t_names] + [str(sum(t_count.values()))])
+    if t_detail:
+      t_chars = dict([(y, x) for x, y in status_chars.items()])
+      print '\n' + '\t'.join(['sample'] + t_columns)
+      for t_sample_id, t_row in t_status['samples'].items():
+        print '\t'.join([t_sample_id] + [t_chars.get(x, 'ready') if x != ' ' else '' for x in t_row])
+  else:
+    print '{0}  total jobs: {1}, {2}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t_status['time'])),
+      t_status['total'], ', '.join(['{0}: {1}'.format(x, t_status['status'][x]) for x in t_names if x in t_status['status']]))
+    t_len = max([len(x) for x in t_columns] + [3])
+    for t_job_id in t_columns:
+      t_count = t_status['jobs'][t_job_id]
+      print '  {0}  {1}'.format(t_job_id.ljust(t_len), ', '.join(['{0}: {1}'.format(x, t_count[x]) for x in t_names if x in t_count]))
+    if t_detail:
+      for t_sample_id, t_row in t_status['samples'].items():
+        print '  {0}\t{1}'.format(t_sample_id, ' '.join(t_row))
+  return
+
+
+def task_watch(t_format, t_detail, t_interval):
+  '''print status from WF-sh/WF-status.json when it changes, until the workflow is finished or stopped'''
+  t_time = None
+  while 1:
+    t_status = status_read()
+    if t_status is None:
+      fatal_error('no status file {0}, the workflow has not been run by this version'.format(status_file), exit_code=1)
+    if t_status['time'] != t_time:
+      t_time = t_status['time']
+      status_print(t_status, t_format, t_detail, t_indent=None)
+      if t_format == 'tsv': print ''
+      sys.stdout.flush()
+    if t_status['finished']: return
+    if status_read(t_live=True) is None:
+      print 'workflow is not running'
+      return
+    time.sleep(t_interval)
+########## END status file
+
+
+def local_resource_available(t_execution_id, t_execution, t_job):
+  '''check that a local sh job fits the free cores and free memory of its execution'''
+  if (execution_submitted[t_execution_id] + t_job['cores_per_cmd'] * t_job['no_parallel']) > \
+      t_execution['cores_per_node']:
+    return False
+  if ('mem_per_node' in t_execution.keys()) and \
+     (execution_mem_submitted[t_execution_id] + t_job.get('mem_per_cmd', 0) * t_job['no_parallel']) > \
+      t_execution['mem_per_node']:
+    return False
+  return True
+
+
+def local_resource_take(t_execution_id, t_job):
+  t_cores, t_mem = local_job_resource(t_job)
+  #### also called for running jobs found on restart, before the main loop sets the counters
+  execution_submitted[ t_execution_id ] = execution_submitted.get(t_execution_id, 0) + t_cores
+  execution_mem_submitted[ t_execution_id ] = execution_mem_submitted.get(t_execution_id, 0) + t_mem
+  return
+
+
+def local_job_resource(t_job):
+  '''cores and memory used by a job / sample'''
+  return (t_job['cores_per_cmd'] * t_job['no_parallel'], t_job.get('mem_per_cmd', 0) * t_job['no_parallel'])
+
+
+def local_reservation(NGS_config, t_execution_id, t_job, t_now):
+  '''earliest time a job fits in a local execution, from expected completion of running jobs
+  also return the cores / memory left over for backfilling at that time'''
+  t_execution = NGS_config.NGS_executions[t_execution_id]
+  t_free_cores = t_execution['cores_per_node'] - execution_submitted[t_execution_id]
+  t_free_mem   = t_execution.get('mem_per_node', 0) - execution_mem_submitted[t_execution_id]
+  t_cores, t_mem = local_job_resource(t_job)
+  if not ('mem_per_node' in t_execution.keys()): t_mem = 0
+
+  t_running = []
+  for t_job_id_2, t_sample_id_2 in jobs_to_check:
+    t_sample_job = job_list[t_job_id_2][t_sample_id_2]
+    if t_sample_job['status'] != 'submitted': continue
+    t_job_2 = NGS_config.NGS_batch_jobs[t_job_id_2]
+    if t_job_2['execution'] != t_execution_id: continue
+    t_end = max(t_sample_job.get('time_submit', t_now) + job_runtime[t_job_id_2], t_now)
+    t_running.append((t_end,) + local_job_resource(t_job_2))
+
+  t_time = t_now
+  for t_end, t_cores_2, t_mem_2 in sorted(t_running):
+    if (t_free_cores >= t_cores) and (t_free_mem >= t_mem): break
+    t_time = t_end
+    t_free_cores += t_cores_2
+    t_free_mem   += t_mem_2
+  return {'time': t_time, 'extra_cores': t_free_cores - t_cores, 'extra_mem': t_free_mem - t_mem}
+
+
+def submit_qsub_pe_job(NGS_config, t_job_id, t_sample_id):
+  '''qsub no_parallel copies of the sh file of a job / sample'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_execution_id = t_job['execution']
+  t_execution = NGS_config.NGS_executions[t_execution_id]
+  t_nodes_per_job  = job_nodes(NGS_config, t_job_id)
+
+  write_job_sh(NGS_config, t_job_id, t_sample_id)
+  job_exit_reset(t_job_id, t_sample_id)
+  pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
+  t_sample_job['pids'] = []
+  for i in range(0, t_job['no_parallel']):
+    t_stderr = t_sample_job['sh_file'] + '.' + str(i) + '.stderr'
+    t_stdout = t_sample_job['sh_file'] + '.' + str(i) + '.stdout'
+
+    pid = queue_backends[queue_system]['submit'](t_execution, t_job_id, t_stderr, t_stdout, t_sample_job['sh_file'])
+    pid_file.write(pid + '\n')
+    t_sample_job['pids'].append(pid)
+    execution_submitted[t_execution_id] += t_nodes_per_job
+    print '{0} submitted for {1}\n'.format(t_sample_job['sh_file'], t_sample_id)
+
+  pid_file.close()
+  t_sample_job['time_submit'] = time.time()
+  inotify_watch_job(t_job_id, t_sample_id)
+  set_job_status(t_job_id, t_sample_id, 'submitted')
+  return
+
+
+def job_nodes(NGS_config, t_job_id):
+  '''number of nodes used by a job / sample on qsub-pe execution'''
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_execution = NGS_config.NGS_executions[ t_job['execution'] ]
+  return t_job['cores_per_cmd'] * t_job['no_parallel'] / t_execution['cores_per_node']
+
+
+def submit_qsub_pe_array_job(NGS_config, t_job_id, t_sample_ids):
+  '''submit many samples of a job as one SGE array job, qsub -t 1-N
+  task i runs the sh file on line i of a manifest, its task id is recorded in .pids of the sample as jobid.taskid'''
+  global array_job_no
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_execution = NGS_config.NGS_executions[ t_job['execution'] ]
+  array_job_no += 1
+  t_array = '{0}/WF-sh/{1}.array.{2}.{3}'.format(pwd, t_job_id, os.getpid(), array_job_no)
+
+  t_tasks = []        #### as [(t_sample_id, copy_no)], line i+1 of manifest
+  for t_sample_id in t_sample_ids:
+    write_job_sh(NGS_config, t_job_id, t_sample_id)
+    job_exit_reset(t_job_id, t_sample_id)
+    for i in range(0, t_job['no_parallel']):
+      t_tasks.append((t_sample_id, i))
+  try:
+    f = open(t_array + '.list', 'w')
+    for t_sample_id, i in t_tasks:
+      f.write('{0} {1}\n'.format(job_list[t_job_id][t_sample_id]['sh_file'], i))
+    f.close()
+    tsh = open(t_array + '.sh', 'w')
+    tsh.write('''{0}
+{1}
+
+set -- `sed -n "${{{3}}}p" {2}.list`
+/bin/bash $1 >$1.$2.stdout 2>$1.$2.stderr
+'''.format(t_execution['template'], t_job['pe_parameter'], t_array, queue_backends[queue_system]['task_id']))
+    tsh.close()
+  except IOError:
+    fatal_error('cannot write to ' + t_array + '.sh', exit_code=1)
+
+  pid = queue_backends[queue_system]['submit'](t_execution, t_job_id, t_array + '.stderr', t_array + '.stdout',
+                                               t_array + '.sh', len(t_tasks))
+  print '{0} submitted for {1} samples\n'.format(t_array + '.sh', len(t_sample_ids))
+
+  t_task_ids = collections.defaultdict(list)
+  for i in range(len(t_tasks)):
+    t_task_ids[ t_tasks[i][0] ].append('{0}.{1}'.format(pid, i+1))
+  for t_sample_id in t_sample_ids:
+    t_sample_job = job_list[t_job_id][t_sample_id]
+    pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
+    pid_file.write('\n'.join(t_task_ids[t_sample_id]) + '\n')
+    pid_file.close()
+    t_sample_job['pids'] = t_task_ids[t_sample_id]
+    t_sample_job['time_submit'] = time.time()
+    inotify_watch_job(t_job_id, t_sample_id)
+    set_job_status(t_job_id, t_sample_id, 'submitted')
+  return
+
+
+def submit_qsub_bundle_jobs(NGS_config, t_job_id, t_sample_ids):
+  '''pack commands of a job, up to cmds_per_node in one qsub, the commands run concurrently on the node
+  each command still writes its own WF.start.date, WF.complete.date and WF.cpu'''
+  global array_job_no
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_execution = NGS_config.NGS_executions[ t_job['execution'] ]
+  t_cmds = []         #### as [(t_sample_id, copy_no)]
+  for t_sample_id in t_sample_ids:
+    write_job_sh(NGS_config, t_job_id, t_sample_id)
+    job_exit_reset(t_job_id, t_sample_id)
+    for i in range(0, t_job['no_parallel']):
+      t_cmds.append((t_sample_id, i))
+
+  t_bundle_ids = collections.defaultdict(list)
+  t_cmds_per_node = t_job['cmds_per_node']
+  for i_start in range(0, len(t_cmds), t_cmds_per_node):
+    t_bundle_cmds = t_cmds[i_start:i_start + t_cmds_per_node]
+    array_job_no += 1
+    t_bundle = '{0}/WF-sh/{1}.bundle.{2}.{3}'.format(pwd, t_job_id, os.getpid(), array_job_no)
+    try:
+      tsh = open(t_bundle + '.sh', 'w')
+      tsh.write(t_execution['template'] + '\n' + qsub_header(t_execution, t_job, len(t_bundle_cmds)) + '\n\n')
+      for t_sample_id, i in t_bundle_cmds:
+        t_sh_file = job_list[t_job_id][t_sample_id]['sh_file']
+        tsh.write('/bin/bash {0} >{0}.{1}.stdout 2>{0}.{1}.stderr &\n'.format(t_sh_file, i))
+      tsh.write('wait\n')
+      tsh.close()
+    except IOError:
+      fatal_error('cannot write to ' + t_bundle + '.sh', exit_code=1)
+
+    pid = queue_backends[queue_system]['submit'](t_execution, t_job_id, t_bundle + '.stderr', t_bundle + '.stdout',
+                                                 t_bundle + '.sh')
+    print '{0} submitted for {1} commands\n'.format(t_bundle + '.sh', len(t_bundle_cmds))
+    for t_sample_id, i in t_bundle_cmds:
+      if not pid in t_bundle_ids[t_sample_id]:
+        t_bundle_ids[t_sample_id].append(pid)
+
+  for t_sample_id in t_sample_ids:
+    t_sample_job = job_list[t_job_id][t_sample_id]
+    pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
+    pid_file.write('\n'.join(t_bundle_ids[t_sample_id]) + '\n')
+    pid_file.close()
+    t_sample_job['pids'] = t_bundle_ids[t_sample_id]
+    t_sample_job['time_submit'] = time.time()
+    inotify_watch_job(t_job_id, t_sample_id)
+    set_job_status(t_job_id, t_sample_id, 'submitted')
+  return
+
+
+def submit_local_sh_job(NGS_config, t_job_id, t_sample_id):
+  '''run no_parallel copies of the sh file of a job / sample in the background'''
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  write_job_sh(NGS_config, t_job_id, t_sample_id)
+  job_exit_reset(t_job_id, t_sample_id)
+  pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
+  t_sample_job['pids'] = []
+  for i in range(0, t_job['no_parallel']):
+    err_f = t_sample_job['sh_file'] + '.' + str(i) + '.err'
+    pid = local_spawn([t_sample_job['sh_file']], err_f)
+    pid_file.write(pid + '\n')
+    t_sample_job['pids'].append(pid)
+  pid_file.close()
+  t_sample_job['time_submit'] = time.time()
+  inotify_watch_job(t_job_id, t_sample_id)
+  set_job_status(t_job_id, t_sample_id, 'submitted')
+  local_resource_take(t_job['execution'], t_job)
+  return
+
+
+########## streaming outputs
+#### a job with 'stream_outputs': ['R1.fa', ...] may stream these files to its downstream job through named pipes
+#### when the job is started, if it has only one downstream job, which waits for nothing else, both are local sh
+#### jobs and both fit the free cores and memory now, $SELF/R1.fa ... are made named pipes and both jobs are
+#### started together on this computer. otherwise the job writes the files as usual
+#### the downstream job must read each streamed file once, from start to end, in the order the job writes them
+#### streamed files are not on disk after the jobs, neither job is saved to the output cache
+def stream_fifo_reset(t_job_id, t_sample_id):
+  '''remove named pipes left by an earlier streamed run of a job / sample'''
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  for t_file in NGS_config.NGS_batch_jobs[t_job_id].get('stream_outputs', []):
+    t_path = t_dir + '/' + t_file
+    if os.path.exists(t_path) and stat.S_ISFIFO(os.stat(t_path).st_mode): os.remove(t_path)
+  return
+
+
+def stream_fifo_left(t_job_id, t_sample_id):
+  '''True if an output of a job / sample is a named pipe left by a streamed run, not a file'''
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  for t_file in NGS_config.NGS_batch_jobs[t_job_id].get('stream_outputs', []):
+    t_path = t_dir + '/' + t_file
+    if os.path.exists(t_path) and stat.S_ISFIFO(os.stat(t_path).st_mode): return True
+  return False
+
+
+def stream_plan(NGS_config, t_job_id, t_sample_id):
+  '''a local job / sample is about to start, return its downstream job to start with it through named pipes
+  or None to run it with files'''
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  if not t_job.get('stream_outputs'): return None
+  stream_fifo_reset(t_job_id, t_sample_id)
+  t_key = (t_job_id, t_sample_id)
+  if len(job_dependents[t_key]) != 1: return None
+  t_job_id_2, t_sample_id_2 = job_dependents[t_key][0]
+  t_sample_job_2 = job_list[t_job_id_2][t_sample_id_2]
+  t_job_2 = NGS_config.NGS_batch_jobs[t_job_id_2]
+  if t_sample_job_2['status'] != 'wait': return None
+  for t_key_3 in t_sample_job_2['upstream']:
+    if (t_key_3 != t_key) and (job_list[ t_key_3[0] ][ t_key_3[1] ]['status'] != 'completed'): return None
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  for i in t_sample_job_2['infiles']:
+    if pwd + '/' + i == t_dir or (pwd + '/' + i).startswith(t_dir + '/'): continue
+    if infile_path(i) is None: return None
+
+  #### both must fit now, the downstream job in addition to this one if on the same execution
+  t_execution_id_2 = t_job_2['execution']
+  t_execution_2 = NGS_config.NGS_executions[t_execution_id_2]
+  if t_execution_2['type'] != 'sh': return None
+  t_cores, t_mem = local_job_resource(t_job) if t_execution_id_2 == t_job['execution'] else (0, 0)
+  t_cores_2, t_mem_2 = local_job_resource(t_job_2)
+  if execution_submitted[t_execution_id_2] + t_cores + t_cores_2 > t_execution_2['cores_per_node']: return None
+  if ('mem_per_node' in t_execution_2.keys()) and \
+     (execution_mem_submitted[t_execution_id_2] + t_mem + t_mem_2 > t_execution_2['mem_per_node']): return None
+
+  try:
+    if not os.path.exists(t_dir): os.makedirs(t_dir)
+    for t_file in t_job['stream_outputs']:
+      t_path = t_dir + '/' + t_file
+      if os.path.lexists(t_path): os.remove(t_path)
+      os.mkfifo(t_path, 0600)
+  except OSError as e:
+    print 'Warning: cannot stream output of {0},{1}: {2}\n'.format(t_job_id, t_sample_id, e)
+    stream_fifo_reset(t_job_id, t_sample_id)
+    return None
+  job_list[t_job_id][t_sample_id].update({'streamed': True, 'stream_to': t_job_id_2})
+  t_sample_job_2.update({'streamed': True, 'stream_from': t_job_id})
+  return (t_job_id_2, t_sample_id_2)
+
+
+def stream_release(t_job_id, t_sample_id):
+  '''a streaming job / sample exited, a reader still waiting for a named pipe it never opened gets end of file'''
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  for t_file in NGS_config.NGS_batch_jobs[t_job_id]['stream_outputs']:
+    try:
+      os.close(os.open(t_dir + '/' + t_file, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+      pass                                         #### no reader
+  return
+########## END streaming outputs
+
+
+def local_spawn(t_args, t_out):
+  '''fork and exec /bin/bash t_args in its own process group, stdin from /dev/null, stdout and stderr to file t_out
+  no shell in between and no pipes, return pid as string'''
+  t_maxfd = os.sysconf('SC_OPEN_MAX')
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.setpgid(0, 0)
+      fd_in  = os.open(os.devnull, os.O_RDONLY)
+      fd_out = os.open(t_out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+      os.dup2(fd_in, 0)
+      os.dup2(fd_out, 1)
+      os.dup2(fd_out, 2)
+      os.closerange(3, t_maxfd)
+      os.execv('/bin/bash', ['/bin/bash'] + t_args)
+    finally:
+      os._exit(127)
+  try:
+    os.setpgid(pid, pid)        #### also set by the child, whichever runs first
+  except OSError:
+    pass
+  local_subprocess[ str(pid) ] = time.time()
+  return str(pid)
+
+
 ########## 2018/11/17
 #### subprocess.Popen results in defunct process 
-#### communicate() with it seem to solve the problem, close the defunct process
+#### reap finished children with os.waitpid(WNOHANG), main loop is woken up by SIGCHLD, never blocks here
 def local_subprocess_communicate():
   for pid in local_subprocess.keys():
-    if os.path.exists('/proc/' + pid):
-      local_subprocess[pid].communicate()
+    try:
+      t_pid, t_status = os.waitpid(int(pid), os.WNOHANG)
+    except OSError as e:
+      if e.errno != errno.ECHILD: raise
+      t_pid, t_status = int(pid), 0
+    if t_pid == 0: continue
+    del local_subprocess[pid]
+    local_exit_status[pid] = t_status
+    if queue_system == 'FAKE': queue_status_invalidate()
+
+
+########## event driven main loop
+#### the main loop blocks in wait_for_events() until
+####   a local sh job exits (SIGCHLD, delivered through a self-pipe)
+####   a WF.exit is written under a watched job dir (inotify, Linux only)
+####   the poll interval of the cluster executions expires
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+
+def sigchld_handler(signum, frame):
+  '''nothing to do here, signal.set_wakeup_fd() writes to the self-pipe'''
+  pass
+
+
+def init_event_sources():
+  '''set up self-pipe for SIGCHLD and inotify instance'''
+  global wakeup_pipe, inotify_fd, libc
+  wakeup_pipe = os.pipe()
+  for fd in wakeup_pipe:
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+  signal.set_wakeup_fd(wakeup_pipe[1])
+  signal.signal(signal.SIGCHLD, sigchld_handler)
+  signal.siginterrupt(signal.SIGCHLD, False)
+
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK)
+    if fd >= 0:
+      inotify_fd = fd
+  except (OSError, AttributeError):
+    inotify_fd = None           #### no inotify, fall back to poll interval
+  return
+
+
+def inotify_watch_job(t_job_id, t_sample_id):
+  '''watch job dir so that writing WF.exit wakes up the main loop'''
+  if inotify_fd is None: return
+  if (t_job_id, t_sample_id) in inotify_watches: return
+  t_dir = pwd + '/' + t_sample_id + '/' + t_job_id
+  if not os.path.exists(t_dir):
+    try:
+      os.makedirs(t_dir)
+    except OSError:
+      return
+  wd = libc.inotify_add_watch(inotify_fd, t_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+  if wd >= 0:
+    inotify_watches[(t_job_id, t_sample_id)] = wd
+  return
+
+
+def inotify_unwatch_job(t_job_id, t_sample_id):
+  if inotify_fd is None: return
+  wd = inotify_watches.pop((t_job_id, t_sample_id), None)
+  if wd is not None:
+    libc.inotify_rm_watch(inotify_fd, wd)
+  return
+
+
+def inotify_read_events():
+  '''drain inotify fd, return True if any WF.exit (or WF.complete.date of sh files without WF.exit) was written'''
+  flag = False
+  while True:
+    try:
+      buf = os.read(inotify_fd, 65536)
+    except OSError as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR): break
+      raise
+    if not buf: break
+    i = 0
+    while i + 16 <= len(buf):
+      wd, mask, cookie, name_len = struct.unpack('iIII', buf[i:i+16])
+      name = buf[i+16:i+16+name_len].rstrip('\0')
+      i += 16 + name_len
+      if name in ('WF.exit', 'WF.complete.date'):
+        flag = True
+  if flag:
+    queue_status_invalidate()   #### a job finished, do not trust cached qstat
+  return flag
+
+
+def drain_wakeup_pipe():
+  while True:
+    try:
+      if not os.read(wakeup_pipe[0], 4096): break
+    except OSError as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR): break
+      raise
+  return
+
+
+def wait_for_events(timeout):
+  '''block until a local job exits, a job completes, or timeout seconds pass'''
+  fds = [wakeup_pipe[0]]
+  if inotify_fd is not None: fds.append(inotify_fd)
+
+  end_time = time.time() + timeout
+  while True:
+    remain = end_time - time.time()
+    if remain <= 0: return
+    try:
+      r, w, x = select.select(fds + work_queue_fds(), work_queue_wfds(), [], remain)
+    except select.error as e:
+      if e[0] == errno.EINTR: continue
+      raise
+    if not (r or w): return
+    #### requests of workers are answered here, they do not need a pass of the main loop
+    if work_queue_server is not None: work_queue_handle(r, w)
+    if not r: continue
+    if wakeup_pipe[0] in r:
+      drain_wakeup_pipe()
+      return
+    if inotify_fd in r and inotify_read_events():
+      return
+  return
+
+
+def get_poll_interval(NGS_config):
+  '''shortest poll interval of cluster executions with jobs in flight'''
+  t_interval = poll_interval_max
+  for t_job_id, t_sample_id in jobs_to_check:
+    if job_list[t_job_id][t_sample_id]['status'] != 'submitted':
+      continue
+    t_job = NGS_config.NGS_batch_jobs[t_job_id]
+    t_execution = NGS_config.NGS_executions[ t_job['execution']]
+    if t_execution['type'] == 'sh':
+      #### a job started by a previous run of this script is not a child, its exit gives no SIGCHLD and may
+      #### come just after its WF.exit is written
+      if not [x for x in job_list[t_job_id][t_sample_id].get('pids', []) if x in local_subprocess or x in local_exit_status]:
+        t_interval = min(t_interval, 1)
+      continue
+    t_interval = min(t_interval, t_execution.get('poll_interval', poll_interval_default))
+  return t_interval
+########## END event driven main loop
+
+
+########## work queue service
+#### commands such as NGS-tools/ann_batch_run_dir.pl run many parallel workers over the files of a dir
+#### instead of lock files, workers of the same queue get items from this service, hosted by the main loop
+#### address is in environment WF_QUEUE of jobs and in WF-sh/WF-queue.addr:
+####   unix:/path/WF-sh/WF-queue.sock, or tcp:127.0.0.1:port with option --work_queue tcp
+#### WF_QUEUE_HOST is the host of the service, workers on other hosts do not use it
+#### one request per line, one reply line per request
+####   ADD queue item ...   => OK number_of_new_items      register items, items already known are ignored
+####   GET queue            => ITEM item | WAIT | END      WAIT: no pending item, but others are running
+####   DONE queue item      => OK                          item completed
+####   FAIL queue item      => OK                          item failed, not given out again
+####   ONCE queue name      => YES | NO                    YES to the first worker only, e.g. to merge output
+####   STATUS queue         => pending n running n done n failed n
+#### items given to a worker are put back to the queue if its connection is closed before DONE / FAIL
+#### queues under the dir of a job / sample are reset when it is submitted again, as after delete-jobs
+#### client sockets are non-blocking, replies a worker does not read yet are kept until it can take them
+work_queues = {}                          # queue => {'pending': deque of items, 'running': {item: fd}, 'done': set(), ...}
+work_queue_clients = {}                   # fd => {'sock': socket, 'buf': unread bytes, 'out': unsent replies,
+                                          #        'items': set((queue, item))}
+
+def work_queue_start():
+  '''listen on a unix socket under WF-sh, or on a tcp port of localhost'''
+  global work_queue_server
+  if work_queue_mode == 'off': return
+  t_sock_file = pwd + '/WF-sh/WF-queue.sock'
+  try:
+    if (work_queue_mode == 'unix') and (len(t_sock_file) < 100):
+      if os.path.exists(t_sock_file): os.remove(t_sock_file)
+      work_queue_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      t_umask = os.umask(077)
+      work_queue_server.bind(t_sock_file)
+      os.umask(t_umask)
+      t_address = 'unix:' + t_sock_file
     else:
-      del local_subprocess[pid]
+      work_queue_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      work_queue_server.bind(('127.0.0.1', 0))
+      t_address = 'tcp:127.0.0.1:{0}'.format(work_queue_server.getsockname()[1])
+    work_queue_server.listen(64)
+    work_queue_server.setblocking(0)
+  except socket.error as e:
+    print 'Warning: cannot start work queue service: {0}\n'.format(e)
+    work_queue_server = None
+    return
+  os.environ['WF_QUEUE'] = t_address
+  os.environ['WF_QUEUE_HOST'] = socket.gethostname()
+  open(pwd + '/WF-sh/WF-queue.addr', 'w').write('{0} {1}\n'.format(t_address, socket.gethostname()))
+  atexit.register(work_queue_stop)
+  return
+
+
+def work_queue_stop():
+  '''close the service, remove WF-sh/WF-queue.sock and WF-sh/WF-queue.addr'''
+  global work_queue_server
+  if work_queue_server is None: return
+  if work_queue_server.family == socket.AF_UNIX:
+    t_sock_file = work_queue_server.getsockname()
+  else:
+    t_sock_file = None
+  work_queue_server.close()
+  work_queue_server = None
+  for t_file in (t_sock_file, pwd + '/WF-sh/WF-queue.addr'):
+    try:
+      if t_file: os.remove(t_file)
+    except OSError:
+      pass
+  return
+
+
+def work_queue_fds():
+  if work_queue_server is None: return []
+  return [work_queue_server.fileno()] + work_queue_clients.keys()
+
+
+def work_queue_wfds():
+  return [x for x in work_queue_clients.keys() if work_queue_clients[x]['out']]
+
+
+def work_queue_reset(t_job_id, t_sample_id):
+  '''a job / sample is submitted again, its queues start over: items are given out and ONCE answered YES again'''
+  t_dir = os.path.realpath(pwd + '/' + t_sample_id + '/' + t_job_id)
+  for t_name, t_queue in work_queues.items():
+    if (t_name == t_dir) or t_name.startswith(t_dir + '/'):
+      t_queue['pending'].clear()
+      for t_key in ('done', 'failed', 'known', 'once'): t_queue[t_key].clear()
+  return
+
+
+def work_queue_send(fd):
+  '''send unsent replies of a worker, as much as its socket takes'''
+  t_client = work_queue_clients[fd]
+  try:
+    n = t_client['sock'].send(t_client['out'])
+  except socket.error as e:
+    if e.errno in (errno.EAGAIN, errno.EINTR): return
+    work_queue_drop(fd)
+    return
+  t_client['out'] = t_client['out'][n:]
+  return
+
+
+def work_queue_handle(r, w=[]):
+  '''accept new workers, answer requests of workers whose sockets are readable, send pending replies to writable'''
+  if work_queue_server.fileno() in r:
+    while True:
+      try:
+        t_sock, t_addr = work_queue_server.accept()
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EINTR): break
+        raise
+      t_sock.setblocking(0)
+      work_queue_clients[t_sock.fileno()] = {'sock': t_sock, 'buf': '', 'out': '', 'items': set()}
+  for fd in [x for x in r if x in work_queue_clients]:
+    t_client = work_queue_clients[fd]
+    try:
+      t_data = t_client['sock'].recv(65536)
+    except socket.error as e:
+      if e.errno in (errno.EAGAIN, errno.EINTR): continue
+      t_data = ''
+    if not t_data:
+      work_queue_drop(fd)
+      continue
+    t_client['buf'] += t_data
+    t_replies = []
+    while '\n' in t_client['buf']:
+      t_line, t_client['buf'] = t_client['buf'].split('\n', 1)
+      t_replies.append(work_queue_request(fd, t_line.split()))
+    t_client['out'] += ''.join([x + '\n' for x in t_replies])
+    if t_client['out']: work_queue_send(fd)
+  for fd in [x for x in w if x in work_queue_clients]:
+    work_queue_send(fd)
+  return
+
+
+def work_queue_request(fd, ll):
+  '''reply to one request of a worker'''
+  if len(ll) < 2: return 'ERROR bad request'
+  t_cmd, t_name = ll[0], ll[1]
+  t_queue = work_queues.setdefault(t_name, {'pending': collections.deque(), 'running': {}, 'done': set(),
+                                            'failed': set(), 'known': set(), 'once': set()})
+  t_items = work_queue_clients[fd]['items']
+  if t_cmd == 'ADD':
+    #### failed items are given out again, e.g. to the workers of a rerun of the job
+    t_retry = [x for x in ll[2:] if x in t_queue['failed']]
+    t_queue['failed'].difference_update(t_retry)
+    t_new = [x for x in ll[2:] if not x in t_queue['known']]
+    t_queue['known'].update(t_new)
+    t_queue['pending'].extend(t_retry + t_new)
+    return 'OK {0}'.format(len(t_retry) + len(t_new))
+  elif t_cmd == 'GET':
+    if t_queue['pending']:
+      t_item = t_queue['pending'].popleft()
+      t_queue['running'][t_item] = fd
+      t_items.add((t_name, t_item))
+      return 'ITEM ' + t_item
+    if t_queue['running']: return 'WAIT'
+    return 'END'
+  elif (t_cmd in ('DONE', 'FAIL')) and (len(ll) == 3):
+    t_item = ll[2]
+    t_queue['running'].pop(t_item, None)
+    t_items.discard((t_name, t_item))
+    t_queue['done' if t_cmd == 'DONE' else 'failed'].add(t_item)
+    return 'OK'
+  elif (t_cmd == 'ONCE') and (len(ll) == 3):
+    if ll[2] in t_queue['once']: return 'NO'
+    t_queue['once'].add(ll[2])
+    return 'YES'
+  elif t_cmd == 'STATUS':
+    return 'pending {0} running {1} done {2} failed {3}'.format(len(t_queue['pending']), len(t_queue['running']),
+                                                                len(t_queue['done']), len(t_queue['failed']))
+  return 'ERROR bad request'
+
+
+def work_queue_drop(fd):
+  '''worker closed its connection or died, its running items go back to the front of their queues'''
+  t_client = work_queue_clients.pop(fd)
+  for t_name, t_item in t_client['items']:
+    t_queue = work_queues[t_name]
+    if t_queue['running'].get(t_item) == fd:
+      del t_queue['running'][t_item]
+      t_queue['pending'].appendleft(t_item)
+      print 'work queue {0}: worker exited, {1} is put back\n'.format(t_name, t_item)
+  t_client['sock'].close()
+  return
+########## END work queue service
 
 
 def run_workflow(NGS_config):
   '''major loop for workflow run'''
-  queue_system = NGS_config.queue_system   #### default "SGE"
-  sleep_time_min = 15
-  sleep_time_max = 120
-  sleep_time = sleep_time_min
+  init_event_sources()
+  work_queue_start()
+
+  #### pick up jobs submitted by a previous run of this script, from state store or from WF-sh/*.pids
+  state_store_restore(NGS_config)
+  check_completed_sh_hash(NGS_config)
+  for t_job_id, t_sample_id in list(jobs_to_check):
+    check_submitted_job(NGS_config, t_job_id, t_sample_id)
+  temp_files_sweep()
 
   while 1:
-    flag_job_done = True
     ########## reset execution_submitted to 0
     for i in NGS_config.NGS_executions.keys():
       execution_submitted[ i ] = False
+      execution_mem_submitted[ i ] = 0
 
-    flag_qstat_xml_call = False
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      t_execution = NGS_config.NGS_executions[ t_job['execution']]
-      exe_type = t_execution['type']
-      if (queue_system == 'SGE') and (exe_type in ['qsub','qsub-pe']):
-        flag_qstat_xml_call = True
-
-    if flag_qstat_xml_call:
-      SGE_qstat_xml_query()
-
+    #### qstat is called by check_any_qsub_pids() only if there are submitted qsub jobs
     ########## 2018/11/17
     local_subprocess_communicate()
 
     ########## check and update job status for submitted jobs
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      if subset_flag:
-        if not (t_job_id in subset_jobs):
-          continue
-      for t_sample_id in NGS_samples:
-        t_sample_job = job_list[t_job_id][t_sample_id]
-        if t_sample_job['status'] == 'completed':
-          continue
+    for t_job_id, t_sample_id in list(jobs_to_check):
+      check_submitted_job(NGS_config, t_job_id, t_sample_id)
 
-        check_submitted_job(NGS_config, t_job_id, t_sample_id)
-        if t_sample_job['status'] == 'completed':
-          continue
-        flag_job_done = False
-
-    if flag_job_done:
+    if job_status_count['completed'] == sum(job_status_count.values()):
       print_job_status_summary(NGS_config)
+      status_publish(t_finished=True)
       print 'job completed!'
       break
 
     ########## check and update job status based on dependance 
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      if subset_flag:
-        if not (t_job_id in subset_jobs):
-          continue
-      for t_sample_id in NGS_samples:
-        t_sample_job = job_list[t_job_id][t_sample_id]
-        if t_sample_job['status'] != 'wait':
+    #### only waiting jobs whose upstream changed, or still waiting for infiles
+    t_cache_hits = 0
+    for t_job_id, t_sample_id in list(jobs_dirty):
+      t_dep = check_job_dependency(t_job_id, t_sample_id)
+      if t_dep == 'ready':
+        if t_job_id in scatter_split_jobs: scatter_plan(NGS_config, t_job_id, t_sample_id)
+        if output_cache_db and output_cache_restore(NGS_config, t_job_id, t_sample_id):
+          t_cache_hits += 1                        #### completed from cache, dependents are checked next loop
           continue
-
-        t_ready_flag = True
-        for i in t_sample_job['infiles']:
-          if os.path.exists(i) and os.path.getsize(i) > 0:
-            continue
-          t_ready_flag = False
-          break
-
-        for i in t_sample_job['injobs']:
-          if job_list[i][t_sample_id]['status'] == 'completed':
-            continue
-          t_ready_flag = False
-          break
-
-        if t_ready_flag:
-          t_sample_job['status'] = 'ready'
-          print '{0},{1}: change status to ready\n'.format(t_job_id, t_sample_id)
+        set_job_status(t_job_id, t_sample_id, 'ready')
+      elif t_dep == 'injobs':
+        jobs_dirty.discard((t_job_id, t_sample_id))
     ########## END check and update job status based on dependance 
 
     ########## submit local sh jobs
+    #### EASY backfill: the first ready job that does not fit gets a reservation,
+    #### later jobs may start only if they do not delay that reservation
     has_submitted_some_jobs = False
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      if subset_flag:
-        if not (t_job_id in subset_jobs):
-          continue
-      t_execution = NGS_config.NGS_executions[ t_job['execution']]
-      t_execution_id = t_job['execution']
+    for t_execution_id in NGS_config.NGS_executions.keys():
+      t_execution = NGS_config.NGS_executions[t_execution_id]
       if t_execution['type'] != 'sh': 
         continue
-      if execution_submitted[t_execution_id] >= t_execution['cores_per_node']:
-        continue
-      for t_sample_id in NGS_samples:
-        t_sample_job = job_list[t_job_id][t_sample_id]
-        if t_sample_job['status'] != 'ready':
-          continue
-        if (execution_submitted[t_execution_id] + t_job['cores_per_cmd'] * t_job['no_parallel']) > \
-            t_execution['cores_per_node']: #### no enough available cores
+      t_now = time.time()
+      t_reservation = None
+      t_not_submitted = []
+      while execution_submitted[t_execution_id] < t_execution['cores_per_node']:
+        t_next = ready_queue_pop(t_execution_id)
+        if t_next is None: break
+        t_job_id, t_sample_id = t_next
+        t_job = NGS_config.NGS_batch_jobs[t_job_id]
+        t_fit = local_resource_available(t_execution_id, t_execution, t_job)
+        if t_reservation is None:
+          if not t_fit:
+            t_reservation = local_reservation(NGS_config, t_execution_id, t_job, t_now)
+        elif t_fit:
+          t_cores, t_mem = local_job_resource(t_job)
+          if t_now + job_runtime[t_job_id] <= t_reservation['time']:
+            pass                                   #### finishes before the reserved job starts
+          elif (t_cores <= t_reservation['extra_cores']) and (t_mem <= t_reservation['extra_mem']):
+            t_reservation['extra_cores'] -= t_cores  #### uses resources the reserved job does not need
+            t_reservation['extra_mem']   -= t_mem
+          else:
+            t_fit = False
+        if not t_fit:
+          t_not_submitted.append(t_next)
           continue
-
-        #### now submitting 
-        pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
-        for i in range(0, t_job['no_parallel']):
-          err_f = t_sample_job['sh_file'] + '.' + str(i) + '.err'
-          #p = subprocess.Popen(['/bin/bash', t_sample_job['sh_file']], shell=True)
-          #p = subprocess.Popen(['/bin/bash' + ' ' + t_sample_job['sh_file'] + ' >/dev/null 2>&1 &' ], shell=True, close_fds=True)
-          #p = subprocess.Popen([t_sample_job['sh_file'] , ' >/dev/null 2>&1 &' ], shell=True, executable='/bin/bash')
-          p = subprocess.Popen(['/bin/bash' + ' ' + t_sample_job['sh_file'] + ' >' + err_f + ' 2>&1' ], shell=True, \
-             executable='/bin/bash', stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, close_fds=True)
-
-          pid_file.write(str(p.pid)+'\n')
-          local_subprocess[ str(p.pid) ] = p
-        pid_file.close()
-        t_sample_job['status'] = 'submitted'
-        print '{0},{1}: change status to submitted\n'.format(t_job_id, t_sample_id)
-        execution_submitted[ t_execution_id ] += t_job['cores_per_cmd'] * t_job['no_parallel'] 
+        t_stream_to = stream_plan(NGS_config, t_job_id, t_sample_id)
+        submit_local_sh_job(NGS_config, t_job_id, t_sample_id)
+        if t_stream_to:
+          print '{0},{1}: streaming to {2}\n'.format(t_job_id, t_sample_id, t_stream_to[0])
+          submit_local_sh_job(NGS_config, t_stream_to[0], t_stream_to[1])
         has_submitted_some_jobs = True
+      for t_job_id, t_sample_id in t_not_submitted:
+        ready_queue_push(t_job_id, t_sample_id)
     ########## END submit local sh jobs
 
-    ########## submit qsub-pe jobs, multiple jobs may share same node
-    for t_job_id in NGS_config.NGS_batch_jobs.keys():
-      t_job = NGS_config.NGS_batch_jobs[t_job_id]
-      if subset_flag:
-        if not (t_job_id in subset_jobs):
-          continue
-      t_execution = NGS_config.NGS_executions[ t_job['execution']]
-      t_execution_id = t_job['execution']
-
-      if t_execution['type'] != 'qsub-pe':
+    ########## submit qsub / qsub-pe jobs, multiple jobs may share same node
+    #### bundle: up to cmds_per_node commands of a job in one node-wide qsub
+    #### array_job: ready samples of a job in one array job
+    for t_execution_id in NGS_config.NGS_executions.keys():
+      t_execution = NGS_config.NGS_executions[t_execution_id]
+      if not (t_execution['type'] in ['qsub', 'qsub-pe']):
         continue
-      if execution_submitted[t_execution_id] >= t_execution['number_nodes']:
-        continue
-      t_cores_per_node = t_execution['cores_per_node']
-      t_cores_per_cmd  = t_job['cores_per_cmd']
-      t_cores_per_job  = t_cores_per_cmd * t_job['no_parallel']
-      t_nodes_per_job  = t_cores_per_job / t_cores_per_node
-
-      for t_sample_id in NGS_samples:
-        t_sample_job = job_list[t_job_id][t_sample_id]
-        if t_sample_job['status'] != 'ready':
+      t_group_samples = collections.defaultdict(list)
+      while execution_submitted[t_execution_id] < t_execution['number_nodes']:
+        t_next = ready_queue_pop(t_execution_id)
+        if t_next is None: break
+        t_job_id, t_sample_id = t_next
+        if t_execution.get('bundle', False):
+          t_group_samples[t_job_id].append(t_sample_id)   #### submitted below, bundles of a job
+          t_job = NGS_config.NGS_batch_jobs[t_job_id]
+          execution_submitted[t_execution_id] += t_job['no_parallel'] / float(t_job['cmds_per_node'])
           continue
-
-        #### now submitting 
-        pid_file = open( t_sample_job['sh_file'] + '.pids', 'w')
-        for i in range(0, t_job['no_parallel']):
-          t_stderr = t_sample_job['sh_file'] + '.' + str(i) + '.stderr'
-          t_stdout = t_sample_job['sh_file'] + '.' + str(i) + '.stdout'
-
-          qsub_exe = 'qsub'
-          if 'qsub_exe' in t_execution.keys(): qsub_exe = t_execution['qsub_exe']
-          command_line = qsub_exe + ' {0} {1} {2} {3} {4} {5} {6}'.format(t_execution['command_name_opt'], t_job_id,
-                                                                          t_execution['command_err_opt'], t_stderr, 
-                                                                          t_execution['command_out_opt'], t_stdout, t_sample_job['sh_file'])
-          cmd = subprocess.check_output([command_line], shell=True)
-          if re.search('\d+', cmd):
-            pid = re.search('\d+', cmd).group(0)
-            pid_file.write(pid + '\n')
-          else:
-            fatal_error('error submitting jobs')
-          execution_submitted[t_execution_id] += t_nodes_per_job
-          print '{0} submitted for {1}\n'.format(t_sample_job['sh_file'], t_sample_id)
-
-        pid_file.close()
-        t_sample_job['status'] = 'submitted'
+        if t_execution.get('array_job', False):
+          t_group_samples[t_job_id].append(t_sample_id)   #### submitted below, one array job per job
+          execution_submitted[t_execution_id] += job_nodes(NGS_config, t_job_id)
+          continue
+        submit_qsub_pe_job(NGS_config, t_job_id, t_sample_id)
         has_submitted_some_jobs = True
-    ########## END submit qsub-pe jobs, multiple jobs may share same node
-   
-    ########## submit qsub jobs, job bundles disabled here, if need, check the original Perl script
+      for t_job_id in t_group_samples.keys():
+        if t_execution.get('bundle', False):
+          submit_qsub_bundle_jobs(NGS_config, t_job_id, t_group_samples[t_job_id])
+        else:
+          submit_qsub_pe_array_job(NGS_config, t_job_id, t_group_samples[t_job_id])
+        has_submitted_some_jobs = True
+    ########## END submit qsub / qsub-pe jobs, multiple jobs may share same node
 
-    #### if has submitted some jobs, reset waiting time, otherwise double waiting time
+    #### wait until a local job exits, a job writes WF.exit, or the poll interval
+    #### of cluster executions expires
     print_job_status_summary(NGS_config)
-    if has_submitted_some_jobs:
-      sleep_time = sleep_time_min
+    state_store_commit()
+    status_publish()
+    if t_cache_hits:
+      wait_for_events(0)
     else:
-      sleep_time  *= 2
-      if sleep_time > sleep_time_max:
-        sleep_time = sleep_time_max
-    time.sleep(sleep_time);
+      wait_for_events(get_poll_interval(NGS_config))
   #### END while 1:
   return
 #### END def run_workflow(NGS_config)
@@ -726,7 +3074,14 @@ def run_workflow(NGS_config):
 def check_pid(pid):        
   '''Check For the existence of a unix pid. '''
 # opt 1, this doesn't print OSError to stderr
-  return os.path.exists('/proc/' + str(pid))
+# a zombie is not running, e.g. a job of a previous run of this script not reaped yet by its new parent
+  try:
+    f = open('/proc/' + str(pid) + '/stat', 'r')
+    t_stat = f.read()
+    f.close()
+  except IOError:
+    return False
+  return t_stat[t_stat.rfind(')') + 2:t_stat.rfind(')') + 3] != 'Z'
 
 # opt 2,  
 #  try:
@@ -736,21 +3091,75 @@ def check_pid(pid):
 
 
 def check_any_pids(pids):
-  '''Check For the existence of a list of unix pids. return True if any one exist'''
+  '''Check For the existence of a list of unix pids. return True if any one exist
+  children of this script are running until reaped, /proc is only checked for pids of a previous run'''
   for pid in pids:
+    if pid in local_subprocess:
+      return True
+    if pid in local_exit_status:
+      continue
     if check_pid(pid):
       return True
   return False
 
 
-def check_any_qsub_pids(pids):
-  '''Check For the existence of a list of qsub pids. return True if any one exist'''
+def check_any_qsub_pids(NGS_config, pids, t_since=0):
+  '''Check For the existence of a list of qsub pids submitted at t_since. return True if any one exist'''
+  t_qstat_xml_data = queue_status_data(NGS_config, t_since)
   for pid in pids:
-    if pid in qstat_xml_data.keys():
+    if pid in t_qstat_xml_data:
       return True
   return False
 
 
+def job_exit_reset(t_job_id, t_sample_id):
+  '''remove exit records and reset work queues of a previous run before a job / sample is submitted again'''
+  try:
+    os.remove(job_list[t_job_id][t_sample_id]['exit_file'])
+  except OSError:
+    pass
+  work_queue_reset(t_job_id, t_sample_id)
+  return
+
+
+def read_job_exit_records(t_job_id, t_sample_id):
+  '''exit records written by the sh file, one per finished command, as [{'exit': , 'signal': , 'time_end': , ...}]
+  None if there is no WF.exit, e.g. sh file written by an older version of this script'''
+  t_records = []
+  try:
+    f = open(job_list[t_job_id][t_sample_id]['exit_file'], 'r')
+    for line in f:
+      t_record = dict(re.findall('(\w+)=(\S+)', line))
+      if 'exit' in t_record: t_records.append(t_record)
+    f.close()
+  except IOError:
+    return None
+  return t_records
+
+
+def job_finished_status(NGS_config, t_job_id, t_sample_id, t_records=None):
+  '''completed or error of a job / sample whose commands are not running any more
+  decided by exit records, falls back to WF.start.date, WF.complete.date and WF.cpu without exit records'''
+  t_job = NGS_config.NGS_batch_jobs[t_job_id]
+  t_sample_job = job_list[t_job_id][t_sample_id]
+  if t_records is None:
+    t_records = read_job_exit_records(t_job_id, t_sample_id)
+  if t_records is None:
+    if validate_job_files(t_job_id, t_sample_id): return 'completed'
+    return 'error'
+  if t_records:
+    t_sample_job['time_end'] = max([int(x.get('time_end', 0)) for x in t_records])
+    t_sample_job['exit_status'] = max([int(x['exit']) for x in t_records])
+  if len(t_records) < t_job['no_parallel']: return 'error'     #### some command killed before it can write
+  for t_record in t_records:
+    if t_record['exit'] != '0':
+      if job_list[t_job_id][t_sample_id]['status'] != 'error':
+        print '{0},{1}: command on {2} exit status {3}, signal {4}'.format(t_job_id, t_sample_id, t_record.get('host', ''),
+                                                                       t_record['exit'], t_record.get('signal', 0))
+      return 'error'
+  return 'completed'
+
+
 def validate_job_files(t_job_id, t_sample_id):
   '''return True if necessary file exist'''
   t_sample_job = job_list[t_job_id][t_sample_id]
@@ -772,21 +3181,22 @@ def check_submitted_job(NGS_config, t_job_id, t_sample_id):
   t_execution = NGS_config.NGS_executions[ t_job['execution']]
 
   t_sh_pid = t_sample_job['sh_file'] + '.pids'
-  if not os.path.exists(t_sh_pid): return
+  pids = t_sample_job.get('pids') #### either pids, or qsub ids, from submission or from state store
+  if not pids:
+    if not os.path.exists(t_sh_pid): return
+    try:
+      f = open(t_sh_pid, 'r')
+      pids = f.readlines()
+      f.close()
+      pids = [x.strip() for x in pids]
+    except IOError:
+      fatal_error('cannot open ' + t_sh_pid, exit_code=1)
+    t_sample_job['pids'] = pids
 
   status = t_sample_job['status']
   if ((status == 'wait') or (status == 'ready')):
-    t_sample_job['status'] = 'submitted'
-    print '{0},{1}: change status to submitted\n'.format(t_job_id, t_sample_id)
-
-  pids = [] #### either pids, or qsub ids
-  try:
-    f = open(t_sh_pid, 'r')
-    pids = f.readlines()
-    f.close()
-    pids = [x.strip() for x in pids]
-  except IOError:
-    fatal_error('cannot open ' + t_sh_pid, exit_code=1)
+    t_sample_job['time_submit'] = os.path.getmtime(t_sh_pid)
+    set_job_status(t_job_id, t_sample_id, 'submitted')
 
   if len(pids) == 0:
     fatal_error('empty file ' + t_sh_pid, exit_code=1)
@@ -794,24 +3204,46 @@ def check_submitted_job(NGS_config, t_job_id, t_sample_id):
   exe_type = t_execution['type']
   if (exe_type == 'sh'):
     if check_any_pids(pids):    #### still running
-      execution_submitted[ t_job['execution'] ] += t_job['cores_per_cmd'] * t_job['no_parallel']
-    elif validate_job_files(t_job_id, t_sample_id):                       #### job finished
-      t_sample_job['status'] = 'completed'
-      print '{0},{1}: change status to completed\n'.format(t_job_id, t_sample_id)
-    else:
-      t_sample_job['status'] = 'error'
-      print '{0},{1}: change status to error\n'.format(t_job_id, t_sample_id)
+      local_resource_take(t_job['execution'], t_job)
+      return
+    status = job_finished_status(NGS_config, t_job_id, t_sample_id)
+    if t_sample_job.get('stream_to') and not status_read_only: stream_release(t_job_id, t_sample_id)
+    if t_sample_job.get('stream_from'):
+      #### input streamed from an upstream job, it is only complete if the upstream job completed
+      t_status_2 = job_list[ t_sample_job['stream_from'] ][t_sample_id]['status']
+      if t_status_2 == 'submitted': return
+      if (t_status_2 == 'error') and (status == 'completed'):
+        if t_sample_job['status'] != 'error':
+          print '{0},{1}: streamed input from failed {2}\n'.format(t_job_id, t_sample_id, t_sample_job['stream_from'])
+        if os.path.exists(t_sample_job['complete_file']) and not status_read_only:
+          os.remove(t_sample_job['complete_file'])
+        status = 'error'
+    if output_cache_db and (status == 'completed') and not status_read_only:
+      output_cache_save(NGS_config, t_job_id, t_sample_id)
+    if (status == 'error') and (t_sample_job['status'] != 'error'):
+      for pid in pids:
+        t_status = local_exit_status.get(pid, 0)
+        if os.WIFSIGNALED(t_status):
+          print '{0},{1}: process {2} killed by signal {3}'.format(t_job_id, t_sample_id, pid, os.WTERMSIG(t_status))
+    set_job_status(t_job_id, t_sample_id, status)
+    inotify_unwatch_job(t_job_id, t_sample_id)
     return
 
   elif ((exe_type == 'qsub') or (exe_type == 'qsub-pe')):
-    if check_any_qsub_pids(pids):    #### still running
-      pass
-    elif validate_job_files(t_job_id, t_sample_id):                       #### job finished
-      t_sample_job['status'] = 'completed'
-      print '{0},{1}: change status to completed\n'.format(t_job_id, t_sample_id)
-    else:
-      t_sample_job['status'] = 'error'
-      print '{0},{1}: change status to error\n'.format(t_job_id, t_sample_id)
+    #### all commands wrote exit records, no need to wait until the job leaves the queue
+    t_records = read_job_exit_records(t_job_id, t_sample_id)
+    if (t_records is None) or (len(t_records) < t_job['no_parallel']):
+      if check_any_qsub_pids(NGS_config, pids, t_sample_job.get('time_submit', 0)):    #### still running
+        return
+    status = job_finished_status(NGS_config, t_job_id, t_sample_id)
+    if (status == 'error') and (t_sample_job['status'] != 'error'):
+      for pid in pids:
+        t_exit = queue_backends[queue_system]['accounting'](pid)
+        if t_exit: print '{0},{1}: job {2} exit status {3}'.format(t_job_id, t_sample_id, pid, t_exit)
+    if output_cache_db and (status == 'completed') and not status_read_only:
+      output_cache_save(NGS_config, t_job_id, t_sample_id)
+    set_job_status(t_job_id, t_sample_id, status)
+    inotify_unwatch_job(t_job_id, t_sample_id)
   else:
     fatal_error('unknown execution type: '+ exe_type, exit_code=1)
   return
@@ -861,13 +3293,36 @@ to run sub set of jobs: -j qc or -j qc,fastqc
 write-sh: write sh files and quite
 log-cpu: gathering cpu time for each run for each sample
 list-jobs: list jobs
-snapshot: snapshot current job status
+snapshot: snapshot current job status, or with --format export job status counts
+watch: print job status of the running workflow when it changes, every -Z seconds (default 5)
+cache-stats: print size, quota, hits and misses of output cache given by --cache
+rebuild-state: rebuild job state store WF-sh/WF-state.db from WF-sh/*.pids and WF.* files
 delete-jobs: delete jobs, must supply jobs delete syntax by option -Z
   e.g. -J delete-jobs -Z jobids:assembly,blast  ---delete assembly,blast and all jobs depends on them
        -J delete-jobs -Z run_after:filename     ---delete jobs that has start time (WF.start.date) after this file, and all depending jobs
   ''')
   parser.add_argument('-Z', '--second_parameter', help='secondary parameter used by other options, such as -J')
-  parser.add_argument('-Q', '--queye', help='queue system, e.g. PBS, SGE', default='SGE')
+  parser.add_argument('-Q', '--queye', help='''queue system for qsub / qsub-pe executions: SGE, SLURM, PBS or FAKE
+default is queue_system in workflow configration file, or SGE
+FAKE runs the jobs on this computer through a fake batch system, for testing
+  ''')
+  parser.add_argument('--cache', help='''output cache directory, optional
+a job / sample whose command, CMD_opts and input files are the same as in an earlier run, in this
+or another project using the same cache, is not run again, its output is linked from the cache
+  ''')
+  parser.add_argument('--cache_quota', type=float, default=0, help='''max size of output cache in GB, kept by the cache
+default is the quota given before, or no limit''')
+  parser.add_argument('--work_queue', choices=['unix', 'tcp', 'off'], default='unix', help='''work queue service for
+parallel workers of batch-run commands, e.g. NGS-tools/ann_batch_run_dir.pl
+unix: unix socket WF-sh/WF-queue.sock (default), tcp: a port of localhost, off: no service, workers use lock files''')
+  parser.add_argument('--policy', choices=['breadth', 'depth', 'lpt'], default='breadth', help='''order of submitting ready jobs
+breadth: job by job, each job runs for all samples before downstream jobs (default)
+depth:   sample by sample, complete whole samples first to free disk and deliver results early
+lpt:     samples with largest input ($DATA files) first, to minimize total run time
+  ''')
+  parser.add_argument('--format', choices=['json', 'tsv'], help='''format of -J snapshot and -J watch
+json or tsv: number of job / samples by status and by job, default for -J watch is text''')
+  parser.add_argument('--detail', action='store_true', help='with --format or -J watch, also status of each job / sample')
 
   args = parser.parse_args()
 
@@ -878,9 +3333,31 @@ delete-jobs: delete jobs, must supply jobs delete syntax by option -Z
   for line in re.split(',', args.input):
     NGS_config = imp.load_source('NGS_config', line)
 
+  if args.task == 'watch':
+    task_watch(args.format or 'text', args.detail, float(args.second_parameter or 5))
+    exit(0)
+  if (args.task == 'snapshot') and args.format:
+    #### status of the running workflow, without loading jobs
+    t_status = status_read(t_live=True)
+    if t_status:
+      status_print(t_status, args.format, args.detail)
+      exit(0)
+
+  if args.format: sys.stdout = sys.stderr    #### stdout is only for the status export
+  status_read_only = (args.task == 'snapshot') and bool(args.format)
   print banner
+  schedule_policy = args.policy
+  work_queue_mode = args.work_queue
+  queue_system = (args.queye or getattr(NGS_config, 'queue_system', 'SGE')).upper()
+  if not queue_system in queue_backends:
+    fatal_error('unknown queue system: ' + queue_system, exit_code=1)
   read_samples(args)
   read_parameters(args)
+  expand_scatter_jobs(NGS_config)
+  if args.cache:
+    output_cache_dir = os.path.abspath(args.cache)
+    output_cache_quota = int(args.cache_quota * 1024 * 1024 * 1024)
+    output_cache_open()
 
   if args.jobs:
     subset_flag = True
@@ -890,22 +3367,38 @@ delete-jobs: delete jobs, must supply jobs delete syntax by option -Z
     print subset_jobs
     print '\n'
 
-  if not os.path.exists('WF-sh'): os.system('mkdir WF-sh')
+  if not (os.path.exists('WF-sh') or status_read_only): os.system('mkdir WF-sh')
 
   task_level_jobs(NGS_config)
   make_job_list(NGS_config)
+  state_store_open()
 
   if args.task:
     if args.task == 'list-jobs':
       task_list_jobs(NGS_config)
       exit(0)
     elif args.task == 'snapshot':
-      task_snapshot(NGS_config)
+      if args.format:
+        snapshot_refresh(NGS_config)
+        sys.stdout = sys.__stdout__
+        status_print(status_data(), args.format, args.detail)
+      else:
+        task_snapshot(NGS_config)
       exit(0)
     elif args.task == 'delete-jobs':
       task_delete_jobs(NGS_config, args.second_parameter)
       exit(0)
     elif args.task == 'write-sh':
+      state_store_restore(NGS_config)
+      task_write_sh(NGS_config)
+      exit(0)
+    elif args.task == 'cache-stats':
+      if not output_cache_db: fatal_error('no output cache, use --cache', exit_code=1)
+      task_cache_stats()
+      exit(0)
+    elif args.task == 'rebuild-state':
+      state_store_rebuild(NGS_config)
+      print_job_status_summary(NGS_config)
       exit(0)
     else:
       fatal_error('undefined task' + args.task, exit_code=1)
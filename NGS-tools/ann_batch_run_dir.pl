@@ -27,6 +27,10 @@ if your command has ">" "<" or "|", please use "\>" "\<" "\|"
 
 if there are multiple input dirs such as --INDIR2, this dir should contains corrsponding 1024 files with same name as the master input dir, INDIR1
 otherwise, command will skip
+
+multiple copies of this script can run in parallel on the same dirs. when started by NG-Omics-WF.py,
+files are handed out to the copies by its work queue service (environment WF_QUEUE), a file of a copy
+that dies is given to another copy. otherwise, each copy skips files locked by other copies
 EOD
 
 my $script_name = $0;
@@ -34,6 +38,7 @@ my $script_dir = $0;
    $script_dir =~ s/[^\/]+$//;
    $script_dir = "./" unless ($script_dir);
 require "$script_dir/ann_local.pl";
+use Cwd qw(abs_path);
 
 
 my $cpu_file = "cpu.log";
@@ -70,17 +75,68 @@ my $master_dir = $dir{"INDIR1"};
 die "No master input dir" unless ($master_dir);
 die "No output dir" unless ($dir{"OUTDIR1"});
 
-LL_random_sleep(10);
-my @seqs = LL_get_active_ids($master_dir); LL_shuffle_array(\@seqs);
+my @seqs = LL_get_active_ids($master_dir);
 
 foreach $t_dir (keys %dir) {
   next unless ($t_dir =~ /^OUTDIR\d+/);
   $cmd = `mkdir -p $dir{$t_dir}` unless (-e $dir{$t_dir});
 }
-LL_random_sleep(10);
 
-foreach $i (@seqs) {
-  LL_random_sleep(1);
+#### with the work queue service of NG-Omics-WF.py, files are handed out to the parallel workers by the service
+#### otherwise workers go through the files in random order, and skip files locked by other workers
+my $queue_sock = LL_queue_connect();
+my $queue = abs_path($dir{'OUTDIR1'});
+if ($queue_sock) {
+  LL_queue_add($queue_sock, $queue, @seqs);
+  while(1) {
+    my $r = LL_queue_request($queue_sock, "GET $queue");
+    if (not defined($r)) {                 # service is gone, continue with lock files
+      $queue_sock = undef;
+      last;
+    }
+    last if ($r eq "END");
+    if ($r eq "WAIT") { select(undef, undef, undef, 0.2); next; }  # other workers run the last files
+    my ($tag, $i) = split(/ /, $r, 2);
+    my $status = run_file($i, 0) ? "DONE" : "FAIL";
+    if (not defined(LL_queue_request($queue_sock, "$status $queue $i"))) {
+      $queue_sock = undef;                 # service is gone, continue with lock files
+      last;
+    }
+  }
+}
+
+if (not $queue_sock) {
+  LL_random_sleep(10);
+  LL_shuffle_array(\@seqs);
+  foreach $i (@seqs) {
+    LL_random_sleep(1);
+    run_file($i, 1);
+  }
+  LL_random_sleep(10);
+}
+
+if ($merge_output) {
+  my $r = $queue_sock ? LL_queue_request($queue_sock, "ONCE $queue merge") : undef;
+  if (defined($r)) {
+    merge_files() if ($r eq "YES");
+  }
+  else {
+    my $lockf = "$master_dir.lock";
+    if (not (-e $lockf)) {
+      $cmd = `date > $lockf`;
+      merge_files();
+      $cmd = `rm -f $lockf`;
+    }
+  }
+}
+
+my ($tu,$ts,$cu,$cs)=times(); my $tt=$tu+$ts+$cu+$cs;
+$cmd = `echo $dir{'OUTDIR1'} $tt >> $cpu_file`;
+
+#### run the command for file $i, unless its output exists, return 1 if the command succeeded or was not needed
+sub run_file {
+  my ($i, $use_lock) = @_;
+  my ($t_dir, $f1, $cmd);
   my $cmd1 = $cmd_line;
 
   my $file_ready_flag = 1;
@@ -98,35 +154,24 @@ foreach $i (@seqs) {
 
   if ($file_ready_flag == 0) {
     print STDERR "skip \"$cmd1\", file $file_not_ready does not exist\n";
-    next;
+    return 0;
   }
 
   my $pri_output = "$dir{'OUTDIR1'}/$i";
 
-  next if (-s $pri_output);        # output file exist
-  next if (-s "$pri_output.gz");
-  next if (-e "$pri_output.lock"); # being calculated by another parallelly
+  return 1 if (-s $pri_output);        # output file exist
+  return 1 if (-s "$pri_output.gz");
+  if ($use_lock) {
+    return 1 if (-e "$pri_output.lock"); # being calculated by another parallelly
+    $cmd = `date > $pri_output.lock`;
+  }
   print STDERR "$cmd1\n\n";
-  $cmd = `date > $pri_output.lock`;
   $cmd = `$cmd1`;
-  $cmd = `rm -f $pri_output.lock`;
-
-}
-
-LL_random_sleep(10);
-
-if ($merge_output) {
-  my $lockf = "$master_dir.lock";
-  if (not (-e $lockf)) {
-    $cmd = `date > $lockf`;
-    merge_files();
-    $cmd = `rm -f $lockf`;
-  }
+  my $ok = ($? == 0) ? 1 : 0;
+  $cmd = `rm -f $pri_output.lock` if ($use_lock);
+  return $ok;
 }
 
-my ($tu,$ts,$cu,$cs)=times(); my $tt=$tu+$ts+$cu+$cs;
-$cmd = `echo $dir{'OUTDIR1'} $tt >> $cpu_file`;
-
 sub merge_files {
   my ($i, $j, $k, $t_dir);
 
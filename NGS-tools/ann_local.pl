@@ -8,6 +8,10 @@
 ##                                      http://weizhong-lab.ucsd.edu
 ## ==============================================================================
 
+use IO::Socket::UNIX;
+use IO::Socket::INET;
+use Sys::Hostname;
+
 sub LL_random_sleep {
   my $a = shift;
      $a = 10 unless (defined ($a));
@@ -17,6 +21,49 @@ sub LL_random_sleep {
 # END LL_random_sleep
 
 
+#### client of the work queue service of NG-Omics-WF.py, address in environment WF_QUEUE
+#### return a connected socket, undef if there is no service, or it runs on another host
+#### SIGPIPE is ignored, a write to a service that is gone fails instead of killing the worker
+sub LL_queue_connect {
+  my $addr = $ENV{WF_QUEUE};
+  return undef unless ($addr);
+  return undef if ($ENV{WF_QUEUE_HOST} and ($ENV{WF_QUEUE_HOST} ne hostname()));
+  $SIG{PIPE} = 'IGNORE';
+  my $sock;
+  if    ($addr =~ /^unix:(.+)$/) {
+    $sock = IO::Socket::UNIX->new(Type => SOCK_STREAM(), Peer => $1);
+  }
+  elsif ($addr =~ /^tcp:([^:]+):(\d+)$/) {
+    $sock = IO::Socket::INET->new(PeerAddr => $1, PeerPort => $2, Proto => 'tcp');
+  }
+  return $sock;
+}
+# END LL_queue_connect
+
+
+#### send one request, return the reply line, undef if the service is gone
+sub LL_queue_request {
+  my ($sock, $req) = @_;
+  return undef unless (print $sock "$req\n");
+  my $r = <$sock>;
+  return undef unless (defined($r));
+  chomp($r);
+  return $r;
+}
+# END LL_queue_request
+
+
+#### add items to a queue, 1000 items per request
+sub LL_queue_add {
+  my ($sock, $queue, @items) = @_;
+  while (@items) {
+    my @t = splice(@items, 0, 1000);
+    LL_queue_request($sock, "ADD $queue " . join(" ", @t));
+  }
+}
+# END LL_queue_add
+
+
 sub LL_get_active_ids {
   my $seq_dir = shift;
   opendir(DIR, $seq_dir) || die "Can not open seq dir";
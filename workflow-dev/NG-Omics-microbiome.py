@@ -34,6 +34,7 @@ NGS_executions['qsub_1'] = {
 NGS_executions['sh_1'] = {
   'type'                : 'sh',
   'cores_per_node'      : 8,
+  'mem_per_node'        : 64000,      #### MB, jobs with mem_per_cmd are packed on both cores and memory
   'number_nodes'        : 1,
   'template'            : '''#!/bin/bash
 
@@ -315,6 +316,7 @@ NGS_batch_jobs['cd-hit-kegg'] = {
   'CMD_opts'       : ['kegg/keggf'],
   'execution'      : 'qsub_1',        # where to execute
   'cores_per_cmd'  : 16,              # number of threads used by command below
+  'mem_per_cmd'    : 32000,           # memory (MB) used by command below, same as cd-hit -M
   'no_parallel'    : 1,               # number of total jobs to run using command below
   'command'        : '''
 $ENV.NGS_root/apps/cd-hit/cd-hit-2d -i $ENV.NGS_root/refs/$CMDOPTS.0 -i2 $INJOBS.0/ORF.faa -o $SELF/out \\
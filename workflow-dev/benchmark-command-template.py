@@ -0,0 +1,75 @@
+#!/usr/bin/python
+################################################################################
+# benchmark of command rendering in make_job_list of NG-Omics-WF.py
+# compiled command template vs. one re.sub per placeholder (before the template engine)
+#
+# usage: python benchmark-command-template.py [workflow_config] [no_samples] [no_jobs]
+# default: workflow-examples/NG-Omics-microbiome-example.py, 10000 samples, 20 jobs
+# jobs of the configuration file are repeated to get no_jobs jobs
+################################################################################
+
+import os
+import sys
+import re
+import time
+import imp
+
+t_dir = os.path.dirname(os.path.abspath(__file__))
+WF = imp.load_source('NG_Omics_WF', t_dir + '/../NG-Omics-WF.py')
+
+
+def render_command_re_sub(t_job, t_job_id, t_sample_id, t_sample_data, t_env, t_cmd_opts):
+  '''command rendering before the template engine, one re.sub per placeholder'''
+  t_command = t_job[ 'command' ]
+  t_command = re.sub('\$SAMPLE', t_sample_id, t_command)
+  t_command = re.sub('\$SELF'  , t_job_id, t_command)
+  for i in t_env.keys():
+    t_command = re.sub('\$ENV.'+i, t_env[i], t_command)
+  for i_data in range(0, len(t_sample_data)):
+    t_command = re.sub('\$DATA\.' + str(i_data), t_sample_data[i_data], t_command)
+  t_injobs = t_job.get('injobs', [])
+  for i_data in range(0, len(t_injobs)):
+    t_command = re.sub('\$INJOBS\.' + str(i_data), t_injobs[i_data], t_command)
+  for i_data in range(0, len(t_cmd_opts)):
+    t_command = re.sub('\$CMDOPTS\.' + str(i_data), t_cmd_opts[i_data], t_command)
+  return t_command
+
+
+if __name__ == "__main__":
+  t_config_file = t_dir + '/../workflow-examples/NG-Omics-microbiome-example.py'
+  if len(sys.argv) > 1: t_config_file = sys.argv[1]
+  no_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+  no_jobs    = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+  NGS_config = imp.load_source('NGS_config', t_config_file)
+  t_job_ids = sorted(NGS_config.NGS_batch_jobs.keys())
+  t_jobs = [t_job_ids[i % len(t_job_ids)] for i in range(no_jobs)]
+  t_samples = ['Sample_{0}'.format(i) for i in range(no_samples)]
+  t_sample_data = dict([(x, ['/data/{0}/R{1}.fastq.gz'.format(x, i) for i in (1, 2)]) for x in t_samples])
+
+  t_start = time.time()
+  t_out_1 = []
+  for t_job_id in t_jobs:
+    t_job = NGS_config.NGS_batch_jobs[t_job_id]
+    t_cmd_opts = t_job.get('CMD_opts', [])
+    for t_sample_id in t_samples:
+      t_out_1.append(render_command_re_sub(t_job, t_job_id, t_sample_id, t_sample_data[t_sample_id],
+                                           NGS_config.ENV, t_cmd_opts))
+  t_time_1 = time.time() - t_start
+
+  t_start = time.time()
+  t_out_2 = []
+  for t_job_id in t_jobs:
+    t_job = NGS_config.NGS_batch_jobs[t_job_id]
+    t_template = WF.compile_command_template(t_job['command'], t_job_id, NGS_config.ENV,
+                                             t_job.get('injobs', []), t_job.get('CMD_opts', []))
+    for t_sample_id in t_samples:
+      t_out_2.append(WF.render_command_template(t_template, t_sample_id, t_sample_data[t_sample_id]))
+  t_time_2 = time.time() - t_start
+
+  no_diff = len([i for i in range(len(t_out_1)) if t_out_1[i] != t_out_2[i]])
+  print '{0} samples x {1} jobs = {2} commands'.format(no_samples, no_jobs, len(t_out_1))
+  print 're.sub per placeholder: {0:.2f} seconds'.format(t_time_1)
+  print 'compiled template:      {0:.2f} seconds'.format(t_time_2)
+  print 'speedup:                {0:.1f}x'.format(t_time_1 / max(t_time_2, 1e-6))
+  print 'commands different:     {0}'.format(no_diff)
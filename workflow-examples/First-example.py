@@ -3,7 +3,7 @@
 # NGS workflow by Weizhong Li, http://weizhongli-lab.org
 ################################################################################
 
-queue_system = 'SGE'
+queue_system = 'SGE'    #### SGE, SLURM, PBS, or FAKE to run qsub jobs on this computer for testing; option -Q overrides it
 
 ########## local variables etc. Please edit
 ENV={
@@ -18,6 +18,7 @@ NGS_executions['qsub_1'] = {
   'qsub_exe'            : 'qsub',
   'cores_per_node'      : 32,
   'number_nodes'        : 64,
+  'poll_interval'       : 10,         #### seconds between queue status checks while jobs of this execution are in flight
   'user'                : 'weizhong', #### I will use command such as qstat -u weizhong to query submitted jobs
   'command'             : 'qsub',
   'command_name_opt'    : '-N',
@@ -3,7 +3,7 @@
 # NGS workflow by Weizhong Li, http://weizhongli-lab.org
 ################################################################################
 
-queue_system = 'SGE'
+queue_system = 'SGE'    #### SGE, SLURM, PBS, or FAKE to run qsub jobs on this computer for testing; option -Q overrides it
 
 ########## local variables etc. Please edit
 ENV={
@@ -20,6 +20,10 @@ NGS_executions['qsub_1'] = {
   'qsub_exe'            : 'qsub',
   'cores_per_node'      : 32,
   'number_nodes'        : 64,
+  'poll_interval'       : 10,         #### seconds between queue status checks while jobs of this execution are in flight
+  'array_job'           : False,      #### True: submit ready samples of a job as one array job (qsub -t 1-N)
+  'bundle'              : False,      #### True: run up to cmds_per_node commands of a job in one node-wide qsub
+# 'local_scratch'       : '${TMPDIR:-/tmp}', #### run jobs in a dir on node-local disk, see 'stage_in' / 'stage_out' of jobs
   'command_name_opt'    : '-N',
   'command_err_opt'     : '-e',
   'command_out_opt'     : '-o',
@@ -45,6 +49,7 @@ NGS_batch_jobs = {}
 NGS_batch_jobs['qc'] = {
   'CMD_opts'         : ['100'],
   'non_zero_files' : ['R1.fa','R2.fa','qc.txt'],
+  'compress_outputs' : ['R1.fa','R2.fa'],    # kept as R1.fa.gz, R2.fa.gz, read by downstream jobs with wf_cat
   'execution'        : 'qsub_1',               # where to execute
   'cores_per_cmd'    : 4,                    # number of threads used by command below
   'no_parallel'      : 1,                    # number of total jobs to run using command below
@@ -79,6 +84,7 @@ NGS_batch_jobs['remove-host'] = {
   'injobs'         : ['qc'],          # start with high quality reads
   'CMD_opts'       : ['bwa','host/GRCh38.fa'],         # can be bwa, bowtie2 or skip (do nothing for non-host related sample)
   'non_zero_files' : ['non-host-R1.fa','non-host-R2.fa'],
+  'temp_files'     : ['non-host-R1.fa','non-host-R2.fa'],   # deleted after assembly is completed
   'execution'      : 'qsub_1',        # where to execute
   'cores_per_cmd'  : 16,              # number of threads used by command below
   'no_parallel'    : 1,               # number of total jobs to run using command below
@@ -87,17 +93,17 @@ NGS_batch_jobs['remove-host'] = {
 if [ "$CMDOPTS.0" = "bwa" ]
 then
   $ENV.NGS_root/apps/bin/bwa mem -t 16 -T 60 $ENV.NGS_root/refs/$CMDOPTS.1 \\
-  $INJOBS.0/R1.fa $INJOBS.0/R2.fa | $ENV.NGS_root/NGS-tools/sam-filter-top-pair-or-single.pl -T 60 -F 1 -O $SELF/host-hit.ids | \\
+  <(wf_cat $INJOBS.0/R1.fa) <(wf_cat $INJOBS.0/R2.fa) | $ENV.NGS_root/NGS-tools/sam-filter-top-pair-or-single.pl -T 60 -F 1 -O $SELF/host-hit.ids | \\
   $ENV.NGS_root/apps/bin/samtools view -b -S - > $SELF/host.top.bam
 
-  $ENV.NGS_root/NGS-tools/fasta_fetch_exclude_ids.pl -i $SELF/host-hit.ids -s  $INJOBS.0/R1.fa -o $SELF/non-host-R1.fa
-  $ENV.NGS_root/NGS-tools/fasta_fetch_exclude_ids.pl -i $SELF/host-hit.ids -s  $INJOBS.0/R2.fa -o $SELF/non-host-R2.fa
+  $ENV.NGS_root/NGS-tools/fasta_fetch_exclude_ids.pl -i $SELF/host-hit.ids -s <(wf_cat $INJOBS.0/R1.fa) -o $SELF/non-host-R1.fa
+  $ENV.NGS_root/NGS-tools/fasta_fetch_exclude_ids.pl -i $SELF/host-hit.ids -s <(wf_cat $INJOBS.0/R2.fa) -o $SELF/non-host-R2.fa
   
 elif [ "$CMDOPTS.0" = "skip" ]
 then
-  #### do nothing, simply link 
-  ln -s ../$INJOBS.0/R1.fa $SELF/non-host-R1.fa
-  ln -s ../$INJOBS.0/R2.fa $SELF/non-host-R2.fa
+  #### do nothing, simply uncompress
+  wf_cat $INJOBS.0/R1.fa > $SELF/non-host-R1.fa
+  wf_cat $INJOBS.0/R2.fa > $SELF/non-host-R2.fa
 
 else
   echo "not defined filter-host method"
@@ -186,19 +192,25 @@ $ENV.NGS_root/apps/cd-hit/cd-hit-div.pl $INJOBS.0/ORF.faa               $SELF/or
 }
 
 NGS_batch_jobs['pfam'] = {
-  'injobs'         : ['orf-split'],
+  'injobs'         : ['ORF-prediction'],
   'CMD_opts'       : ['pfam/Pfam-A.hmm'],
   'execution'      : 'qsub_1',        # where to execute
   'cores_per_cmd'  : 4,              # number of threads used by command below
-  'no_parallel'    : 4,               # number of total jobs to run using command below
+  'no_parallel'    : 1,               # number of total jobs to run using command below
+  'scatter'        : {                #### ORFs are split into chunks, each chunk is a job
+    'split'        : '$ENV.NGS_root/apps/cd-hit/cd-hit-div.pl $INJOBS.0/ORF.faa $SELF/chunk $CHUNKS',
+    'max_chunks'   : 256,
+    'chunk_size'   : 4,               #### MB of ORFs per chunk
+  },
   'command'        : '''
-for i in `seq 1 4`
-  do $ENV.NGS_root/NGS-tools/ann_batch_run_dir.pl --INDIR1=$INJOBS.0/orf-split --OUTDIR1=$SELF/pfam --OUTDIR2=$SELF/pfam.2 --OUTDIR3=$SELF/pfam.3 \\
-    --CPU=$SELF/WF.cpu $ENV.NGS_root/apps/hmmer/binaries/hmmscan -E 0.001 -o {OUTDIR1} --notextw --noali --cpu 1 --tblout {OUTDIR2} \\
-    --domtblout {OUTDIR3} $ENV.NGS_root/refs/$CMDOPTS.0 {INDIR1} &
+$ENV.NGS_root/apps/hmmer/binaries/hmmscan -E 0.001 -o $SELF/out --notextw --noali --cpu 4 --tblout $SELF/out.2 \\
+  --domtblout $SELF/out.3 $ENV.NGS_root/refs/$CMDOPTS.0 $CHUNK
+''',
+  'gather'         : '''
+mkdir $SELF/pfam $SELF/pfam.2 $SELF/pfam.3
+for d in $CHUNK_DIRS; do
+  ln -s ../../$d/out $SELF/pfam/$d; ln -s ../../$d/out.2 $SELF/pfam.2/$d; ln -s ../../$d/out.3 $SELF/pfam.3/$d
 done
-wait
-
 '''
 }
 